@@ -1,29 +1,98 @@
 import urllib.request, urllib.error, urllib.parse
+import base64
+import binascii
+import contextlib
 import datetime
+import email.utils
+import json
+import uuid
+from xml.sax.saxutils import escape
 
 from . import xml_templates
 from . import errors
+from .metrics import CountingFile, render as render_metrics
 
 
-def list_buckets(handler):
+# Size of the pieces object bodies are written to the client in
+CHUNK_SIZE = 64 * 1024
+
+
+def health(handler):
+    """Report whether the store has caught up with siad since starting."""
+    file_store = handler.server.file_store
+    ready = file_store.ready.is_set()
+    data = json.dumps({
+        'ready': ready,
+        'buckets': len(file_store.buckets),
+        'error': file_store.refresh_error,
+    }).encode()
+    handler.send_response(200 if ready else 503)
+    handler.send_header('Content-Type', 'application/json')
+    handler.send_header('Content-Length', len(data))
+    handler.end_headers()
+    if handler.command != 'HEAD':
+        handler.wfile.write(data)
+
+
+def metrics(handler):
+    """Serve metrics in the Prometheus text format."""
+    file_store = handler.server.file_store
+    data = render_metrics(handler.server.request_metrics.metrics() + file_store.metrics()).encode()
     handler.send_response(200)
-    handler.send_header('Content-Type', 'application/xml')
+    handler.send_header('Content-Type', 'text/plain; version=0.0.4')
+    handler.send_header('Content-Length', len(data))
     handler.end_headers()
-    buckets = handler.server.file_store.buckets
-    xml = ''
+    if handler.command != 'HEAD':
+        handler.wfile.write(data)
+
+
+def list_buckets(handler):
+    _send_xml_stream(handler, _buckets_xml(handler.server.file_store.buckets))
+
+
+def _buckets_xml(buckets):
+    yield xml_templates.buckets_start_xml
     for bucket in buckets:
-        xml += xml_templates.buckets_bucket_xml.format(bucket=bucket)
-    xml = xml_templates.buckets_xml.format(buckets=xml)
-    handler.wfile.write(xml.encode())
+        yield xml_templates.buckets_bucket_xml.format(bucket=bucket, name=escape(bucket.name))
+    yield xml_templates.buckets_end_xml
 
 
 def ls_bucket(handler, bucket_name, qs):
     bucket = handler.server.file_store.get_bucket(bucket_name)
     if bucket:
+        # ListObjectsV2 pages with continuation tokens rather than markers
+        v2 = qs.get('list-type', [''])[0] == '2'
+        continuation_token = qs.get('continuation-token', [''])[0]
+        start_after = qs.get('start-after', [''])[0]
+        if not v2:
+            marker = qs.get('marker', [''])[0]
+        elif continuation_token:
+            try:
+                marker = _decode_continuation_token(continuation_token)
+            except ValueError:
+                xml = xml_templates.error_invalid_argument_xml.format(
+                    message='The continuation token provided is incorrect',
+                    name=escape(bucket_name),
+                )
+                return _send_xml(handler, xml, 400)
+        else:
+            marker = start_after
+
+        try:
+            max_keys = int(qs.get('max-keys', ['1000'])[0])
+            if max_keys < 0:
+                raise ValueError(max_keys)
+        except ValueError:
+            xml = xml_templates.error_invalid_argument_xml.format(
+                message='Provided max-keys not an integer or within integer range',
+                name=escape(bucket_name),
+            )
+            return _send_xml(handler, xml, 400)
+
         kwargs = {
-            'marker': qs.get('marker', [''])[0],
+            'marker': marker,
             'prefix': qs.get('prefix', [''])[0],
-            'max_keys': qs.get('max-keys', [1000])[0],
+            'max_keys': max_keys,
             'delimiter': qs.get('delimiter', [''])[0],
         }
         try:
@@ -32,104 +101,522 @@ def ls_bucket(handler, bucket_name, qs):
             xml = xml_templates.error_no_such_key_xml.format(name='')
             return _404(handler, xml)
 
-        handler.send_response(200)
-        handler.send_header('Content-Type', 'application/xml')
-        handler.end_headers()
-        contents = ''
-        common_prefixes = ''
-
-        for s3_item in bucket_query.matches:
-            contents += xml_templates.bucket_query_content_xml.format(s3_item=s3_item)
+        _send_xml_stream(handler, _bucket_query_xml(bucket_query, v2, continuation_token, start_after))
+    else:
+        xml = xml_templates.error_no_such_bucket_xml.format(name=bucket_name)
+        return _404(handler, xml)
 
-        for common_prefix in bucket_query.common_prefixes:
-            common_prefixes += xml_templates.common_prefixes_content_xml.format(prefix=common_prefix)
 
-        xml = xml_templates.bucket_query_xml.format(
+def _bucket_query_xml(bucket_query, v2, continuation_token, start_after):
+    if v2:
+        continuation = ''
+        if continuation_token:
+            continuation += xml_templates.bucket_query_continuation_token_xml.format(token=escape(continuation_token))
+        if start_after:
+            continuation += xml_templates.bucket_query_start_after_xml.format(start_after=escape(start_after))
+        yield xml_templates.bucket_query_v2_start_xml.format(
             bucket_query=bucket_query,
-            contents=contents,
-            common_prefixes=common_prefixes
+            name=escape(bucket_query.bucket.name),
+            prefix=escape(bucket_query.prefix),
+            continuation=continuation,
         )
-        handler.wfile.write(xml.encode())
     else:
-        xml = xml_templates.error_no_such_bucket_xml.format(name=bucket_name)
-        return _404(handler, xml)
+        yield xml_templates.bucket_query_start_xml.format(
+            bucket_query=bucket_query,
+            name=escape(bucket_query.bucket.name),
+            prefix=escape(bucket_query.prefix),
+            marker=escape(bucket_query.marker),
+        )
+
+    key_count = 0
+    with contextlib.closing(bucket_query.entries):
+        for key, s3_item in bucket_query.entries:
+            key_count += 1
+            if s3_item is None:
+                yield xml_templates.common_prefixes_content_xml.format(prefix=escape(key))
+            else:
+                yield xml_templates.bucket_query_content_xml.format(s3_item=s3_item, key=escape(key))
+
+    is_truncated = 'true' if bucket_query.is_truncated else 'false'
+    if v2:
+        continuation = ''
+        if bucket_query.is_truncated:
+            continuation = xml_templates.bucket_query_next_continuation_token_xml.format(
+                token=_encode_continuation_token(bucket_query.next_marker),
+            )
+        yield xml_templates.bucket_query_v2_end_xml.format(
+            key_count=key_count,
+            is_truncated=is_truncated,
+            continuation=continuation,
+        )
+    else:
+        next_marker = ''
+        if bucket_query.is_truncated:
+            next_marker = xml_templates.bucket_query_next_marker_xml.format(
+                next_marker=escape(bucket_query.next_marker),
+            )
+        yield xml_templates.bucket_query_end_xml.format(is_truncated=is_truncated, next_marker=next_marker)
+
+
+def _encode_continuation_token(key):
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def _decode_continuation_token(token):
+    """Get the key a continuation token continues after, or raise ValueError."""
+    try:
+        return base64.urlsafe_b64decode(token.encode()).decode()
+    except (binascii.Error, UnicodeError):
+        raise ValueError(token)
 
 
 def get_acl(handler):
-    handler.send_response(200)
+    _send_xml(handler, xml_templates.acl_xml)
+
+
+def not_implemented(handler):
+    xml = xml_templates.error_not_implemented_xml.format(name=escape(handler.path))
+    _send_xml(handler, xml, 501)
+
+
+def slow_down(handler):
+    xml = xml_templates.error_slow_down_xml.format(name=escape(handler.path))
+    _send_xml(handler, xml, 503)
+
+
+def _404(handler, xml):
+    _send_xml(handler, xml, 404)
+
+
+def _send_xml(handler, xml, status=200, headers={}):
+    data = xml.encode()
+    handler.send_response(status)
     handler.send_header('Content-Type', 'application/xml')
+    handler.send_header('Content-Length', len(data))
+    for key, value in headers.items():
+        handler.send_header(key, value)
     handler.end_headers()
-    handler.wfile.write(xml_templates.acl_xml.encode())
+    if handler.command != 'HEAD':
+        handler.wfile.write(data)
 
 
-def _404(handler, xml):
-    handler.send_response(404)
+def _send_xml_stream(handler, parts, status=200):
+    """Send an XML document as it's generated, a string at a time, by parts.
+
+    It's sent with chunked encoding, buffered into chunks of up to
+    CHUNK_SIZE, except to HTTP/1.0 clients which get it as is and the
+    connection closed after.
+    """
+    chunked = handler.request_version == 'HTTP/1.1'
+    handler.send_response(status)
     handler.send_header('Content-Type', 'application/xml')
+    if chunked:
+        handler.send_header('Transfer-Encoding', 'chunked')
+    else:
+        handler.send_header('Connection', 'close')
+        handler.close_connection = True
     handler.end_headers()
-    handler.wfile.write(xml.encode())
+
+    with contextlib.closing(parts):
+        if handler.command == 'HEAD':
+            return
+
+        buffer = []
+        size = 0
+        started = False
+        for part in parts:
+            data = part.encode()
+            buffer.append(data)
+            size += len(data)
+            # Send the start of the document straight away
+            if size >= CHUNK_SIZE or not started:
+                _write_chunk(handler, b''.join(buffer), chunked)
+                buffer = []
+                size = 0
+                started = True
+
+        _write_chunk(handler, b''.join(buffer), chunked)
+        if chunked:
+            handler.wfile.write(b'0\r\n\r\n')
+
+
+def _write_chunk(handler, data, chunked):
+    if not data:
+        return
+    if chunked:
+        handler.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+    else:
+        handler.wfile.write(data)
 
 
 def get_item(handler, bucket_name, item_name, content=True):
+    headers = {}
+    for key in handler.headers:
+        headers[key.lower()] = handler.headers[key]
+
+    file_store = handler.server.file_store
     try:
-        item = handler.server.file_store.get_item(bucket_name, item_name, content=content)
+        # Content is fetched separately, once we know it's needed and which
+        # range of it
+        item = file_store.get_item(bucket_name, item_name, content=False)
     except errors.NoSuchKey: 
         xml = xml_templates.error_no_such_key_xml.format(name=item_name)
         return _404(handler, xml)
 
     content_length = item.size
 
-    headers = {}
-    for key in handler.headers:
-        headers[key.lower()] = handler.headers[key]
-
     if hasattr(item, 'creation_date'):
         last_modified = item.creation_date
     else:
         last_modified = item.modified_date
-    last_modified = datetime.datetime.strptime(last_modified, '%Y-%m-%dT%H:%M:%S.000Z')
-    last_modified = last_modified.strftime('%a, %d %b %Y %H:%M:%S GMT')
+    modified_date = datetime.datetime.strptime(last_modified, '%Y-%m-%dT%H:%M:%S.000Z')
+    last_modified = modified_date.strftime('%a, %d %b %Y %H:%M:%S GMT')
 
-    if 'range' in headers:
-        handler.send_response(206)
-        handler.send_header('Content-Type', item.content_type)
-        handler.send_header('Last-Modified', last_modified)
-        handler.send_header('Etag', item.md5)
-        handler.send_header('Accept-Ranges', 'bytes')
-        range_ = handler.headers['range'].split('=')[1]
-        start = int(range_.split('-')[0])
-        finish = int(range_.split('-')[1])
-        if finish == 0:
-            finish = content_length - 1
-        bytes_to_read = finish - start + 1
-        handler.send_header('Content-Range', 'bytes %s-%s/%s' % (start, finish, content_length))
-        handler.send_header('Content-Length', '%s' % bytes_to_read)
+    status = _check_conditions(headers, item, modified_date)
+    if status == 304:
+        handler.send_response(304)
+        _send_item_headers(handler, item, last_modified)
         handler.end_headers()
-        item.io.seek(start)
-        handler.wfile.write(item.io.read(bytes_to_read))
         return
+    elif status == 412:
+        xml = xml_templates.error_precondition_failed_xml.format(name=escape(item_name))
+        return _send_xml(handler, xml, 412)
+
+    if 'range' in headers:
+        ranges = _parse_range(headers['range'], content_length)
+        if ranges == []:
+            xml = xml_templates.error_invalid_range_xml.format(name=item_name)
+            return _send_xml(handler, xml, 416, {'Content-Range': 'bytes */%s' % content_length})
+
+        if ranges and len(ranges) == 1:
+            start, finish = ranges[0]
+            handler.send_response(206)
+            handler.send_header('Content-Type', item.content_type)
+            _send_item_headers(handler, item, last_modified)
+            handler.send_header('Content-Range', 'bytes %s-%s/%s' % (start, finish, content_length))
+            handler.send_header('Content-Length', '%s' % (finish - start + 1))
+            handler.end_headers()
+            if handler.command == 'GET':
+                _write_range(handler, item, start, finish)
+            return
+
+        if ranges:
+            return _write_multiple_ranges(handler, item, ranges, last_modified)
+
+        # The range couldn't be parsed, so ignore it
+
+    if content and handler.command == 'GET':
+        item.io = file_store.get_range(item, 0, content_length - 1)
 
     handler.send_response(200)
-    handler.send_header('Last-Modified', last_modified)
-    handler.send_header('Etag', item.md5)
-    handler.send_header('Accept-Ranges', 'bytes')
+    _send_item_headers(handler, item, last_modified)
     handler.send_header('Content-Type', item.content_type)
     handler.send_header('Content-Length', content_length)
     handler.end_headers()
     if handler.command == 'GET':
-        handler.wfile.write(item.io.read())
+        _send_body(handler, item.io, content_length)
+
+
+def _check_conditions(headers, item, modified_date):
+    """Evaluate conditional request headers, as RFC 7232 orders them.
+
+    Returns 304 or 412 if the request shouldn't be served, otherwise None.
+    """
+    if 'if-match' in headers:
+        if not _etag_matches(headers['if-match'], item.md5):
+            return 412
+    elif 'if-unmodified-since' in headers:
+        since = _parse_http_date(headers['if-unmodified-since'])
+        if since and modified_date > since:
+            return 412
+
+    if 'if-none-match' in headers:
+        if _etag_matches(headers['if-none-match'], item.md5):
+            return 304
+    elif 'if-modified-since' in headers:
+        since = _parse_http_date(headers['if-modified-since'])
+        if since and modified_date <= since:
+            return 304
+
+
+def _etag_matches(header, md5):
+    for etag in header.split(','):
+        etag = etag.strip()
+        if etag == '*':
+            return True
+        # Weak comparison, which is all If-None-Match needs and fine for
+        # If-Match as our etags are all strong
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        if md5 and etag.strip('"') == md5:
+            return True
+    return False
+
+
+def _parse_http_date(value):
+    """Parse an HTTP date to a naive UTC datetime, or None if it's invalid."""
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo:
+        date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def _send_item_headers(handler, item, last_modified):
+    handler.send_header('Last-Modified', last_modified)
+    if item.md5:
+        handler.send_header('Etag', '"%s"' % item.md5)
+    handler.send_header('Accept-Ranges', 'bytes')
+
+
+def _parse_range(range_header, size):
+    """Parse a Range header into a list of inclusive (start, finish) pairs.
+
+    Supports start-finish, open ended (start-) and suffix (-length) ranges,
+    comma separated. Returns None if the header is malformed and should be
+    ignored, or an empty list if none of the ranges can be satisfied.
+    """
+    unit, sep, specs = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not sep:
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        first, sep, last = spec.strip().partition('-')
+        try:
+            if not sep:
+                return None
+            elif not first:
+                start = max(size - int(last), 0)
+                finish = size - 1
+                if int(last) == 0:
+                    continue
+            else:
+                start = int(first)
+                finish = int(last) if last else max(start, size - 1)
+        except ValueError:
+            return None
+
+        if finish < start:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(finish, size - 1)))
+
+    return ranges
+
+
+def _write_range(handler, item, start, finish):
+    io = handler.server.file_store.get_range(item, start, finish)
+    _send_body(handler, io, finish - start + 1)
+
+
+def _write_multiple_ranges(handler, item, ranges, last_modified):
+    boundary = uuid.uuid4().hex
+    part_headers = []
+    content_length = len('--%s--\r\n' % boundary)
+    for start, finish in ranges:
+        part_header = (
+            '--%s\r\n'
+            'Content-Type: %s\r\n'
+            'Content-Range: bytes %s-%s/%s\r\n'
+            '\r\n' % (boundary, item.content_type, start, finish, item.size)
+        ).encode()
+        part_headers.append(part_header)
+        content_length += len(part_header) + finish - start + 1 + 2
+
+    handler.send_response(206)
+    _send_item_headers(handler, item, last_modified)
+    handler.send_header('Content-Type', 'multipart/byteranges; boundary=%s' % boundary)
+    handler.send_header('Content-Length', content_length)
+    handler.end_headers()
+    if handler.command != 'GET':
+        return
+
+    for part_header, (start, finish) in zip(part_headers, ranges):
+        handler.wfile.write(part_header)
+        _write_range(handler, item, start, finish)
+        handler.wfile.write(b'\r\n')
+    handler.wfile.write(('--%s--\r\n' % boundary).encode())
+
+
+def _send_body(handler, io, length):
+    """Copy length bytes from io to the client a chunk at a time, then close
+    it.
+
+    When the server's wfile has send_file (the async engine), io is handed
+    over to be sent from the event loop instead, so the handler doesn't wait
+    on slow clients.
+    """
+    send_file = getattr(handler.wfile, 'send_file', None)
+    if send_file:
+        # Counted as it's read, as it doesn't go through wfile.write
+        return send_file(CountingFile(io, handler.server.request_metrics.sent_bytes), length)
+
+    try:
+        while length > 0:
+            chunk = io.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                # The response is short, so the connection can't be reused
+                handler.close_connection = True
+                break
+            handler.wfile.write(chunk)
+            length -= len(chunk)
+    finally:
+        io.close()
 
 
 def delete_item(handler, bucket_name, item_name):
     handler.server.file_store.delete_item(bucket_name, item_name)
 
 
-def delete_items(handler, bucket_name, keys):
+def delete_items(handler, bucket_name, keys, quiet=False):
+    xml = ''
+    for key, error in handler.server.file_store.delete_items(bucket_name, keys):
+        if error:
+            xml += xml_templates.deleted_error_xml.format(
+                key=escape(key),
+                code=_error_code(error),
+                message=escape(getattr(error, 'message', None) or str(error)),
+            )
+        elif not quiet:
+            # Quiet mode only reports errors
+            xml += xml_templates.deleted_deleted_xml.format(key=escape(key))
+    xml = xml_templates.deleted_xml.format(contents=xml)
+    _send_xml(handler, xml)
+
+
+def _error_code(error):
+    """S3 error code for an exception raised deleting a key."""
+    if isinstance(error, errors.NoSuchBucket):
+        return 'NoSuchBucket'
+    return 'InternalError'
+
+
+def copy_item(handler, src_bucket_name, src_item_name, bucket_name, item_name):
+    file_store = handler.server.file_store
+    for name in [src_bucket_name, bucket_name]:
+        if not file_store.get_bucket(name):
+            xml = xml_templates.error_no_such_bucket_xml.format(name=escape(name))
+            return _404(handler, xml)
+
+    content_type = None
+    if handler.headers.get('x-amz-metadata-directive', 'COPY').upper() == 'REPLACE':
+        content_type = handler.headers.get('content-type')
+
+    try:
+        item = file_store.copy_item(src_bucket_name, src_item_name, bucket_name, item_name, content_type)
+    except errors.NoSuchKey:
+        xml = xml_templates.error_no_such_key_xml.format(name=escape(src_item_name))
+        return _404(handler, xml)
+
+    _send_xml(handler, xml_templates.copy_object_result_xml.format(s3_item=item))
+
+
+def _get_upload_bucket(handler, bucket_name):
+    bucket = handler.server.file_store.get_bucket(bucket_name)
+    if not bucket:
+        xml = xml_templates.error_no_such_bucket_xml.format(name=bucket_name)
+        _404(handler, xml)
+    return bucket
+
+
+def _upload_error(handler, e, item_name):
+    if isinstance(e, errors.NoSuchUpload):
+        xml = xml_templates.error_no_such_upload_xml.format(name=escape(item_name))
+        return _404(handler, xml)
+
+    xml = xml_templates.error_invalid_part_xml.format(name=escape(item_name))
+    _send_xml(handler, xml, 400)
+
+
+def create_multipart_upload(handler, bucket_name, item_name):
+    bucket = _get_upload_bucket(handler, bucket_name)
+    if not bucket:
+        return
+
+    upload_id = handler.server.file_store.create_multipart_upload(
+        bucket,
+        item_name,
+        handler.headers.get('content-type'),
+    )
+    xml = xml_templates.initiate_multipart_upload_xml.format(
+        bucket=escape(bucket_name),
+        key=escape(item_name),
+        upload_id=upload_id,
+    )
+    _send_xml(handler, xml)
+
+
+def upload_part(handler, bucket_name, item_name, upload_id, part_number):
+    bucket = _get_upload_bucket(handler, bucket_name)
+    if not bucket:
+        return
+
+    try:
+        md5 = handler.server.file_store.upload_part(bucket, item_name, upload_id, part_number, handler)
+    except (errors.NoSuchUpload, errors.InvalidPart) as e:
+        return _upload_error(handler, e, item_name)
+
     handler.send_response(200)
-    handler.send_header('Content-Type', 'application/xml')
+    handler.send_header('Etag', '"%s"' % md5)
+    handler.send_header('Content-Length', '0')
     handler.end_headers()
+
+
+def list_parts(handler, bucket_name, item_name, upload_id):
+    bucket = _get_upload_bucket(handler, bucket_name)
+    if not bucket:
+        return
+
+    try:
+        parts = handler.server.file_store.list_parts(bucket, item_name, upload_id)
+    except errors.NoSuchUpload as e:
+        return _upload_error(handler, e, item_name)
+
     xml = ''
-    for key in keys:
-        delete_item(handler, bucket_name, key)
-        xml += xml_templates.deleted_deleted_xml.format(key=key)
-    xml = xml_templates.deleted_xml.format(contents=xml)
-    handler.wfile.write(xml.encode())
+    for part in parts:
+        xml += xml_templates.list_parts_part_xml.format(part=part)
+    xml = xml_templates.list_parts_xml.format(
+        bucket=escape(bucket_name),
+        key=escape(item_name),
+        upload_id=upload_id,
+        next_part_number_marker=parts[-1].part_number if parts else 0,
+        parts=xml,
+    )
+    _send_xml(handler, xml)
+
+
+def complete_multipart_upload(handler, bucket_name, item_name, upload_id, parts):
+    bucket = _get_upload_bucket(handler, bucket_name)
+    if not bucket:
+        return
+
+    try:
+        item = handler.server.file_store.complete_multipart_upload(bucket, item_name, upload_id, parts)
+    except (errors.NoSuchUpload, errors.InvalidPart) as e:
+        return _upload_error(handler, e, item_name)
+
+    xml = xml_templates.complete_multipart_upload_xml.format(
+        bucket=escape(bucket_name),
+        key=escape(item_name),
+        etag=item.md5,
+    )
+    _send_xml(handler, xml)
+
+
+def abort_multipart_upload(handler, bucket_name, item_name, upload_id):
+    bucket = _get_upload_bucket(handler, bucket_name)
+    if not bucket:
+        return
+
+    try:
+        handler.server.file_store.abort_multipart_upload(bucket, item_name, upload_id)
+    except errors.NoSuchUpload as e:
+        return _upload_error(handler, e, item_name)
+
+    handler.send_response(204)
+    handler.send_header('Content-Length', '0')
+    handler.end_headers()
@@ -0,0 +1,284 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import socket
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# Longest request line plus headers we'll accept
+MAX_HEAD_SIZE = 64 * 1024
+# Response bytes a handler can queue before waiting for the client
+MAX_BUFFERED = 1024 * 1024
+# Size of the reads files are sent to clients in
+SEND_CHUNK_SIZE = 64 * 1024
+
+
+def _wait(coro, loop, timeout):
+    """Run coro on loop from a handler thread, raising socket.timeout if it
+    takes longer than timeout seconds, like a blocking socket would."""
+    try:
+        return asyncio.run_coroutine_threadsafe(asyncio.wait_for(coro, timeout), loop).result()
+    except asyncio.TimeoutError:
+        raise socket.timeout('timed out')
+
+
+class _StreamReader(object):
+    """Blocking file-like reader over an asyncio stream, for handler threads.
+
+    The already received request head is served first, then reads wait on
+    the event loop, for up to timeout seconds each.
+    """
+
+    def __init__(self, head, reader, loop, timeout=None):
+        self.head = head
+        self.reader = reader
+        self.loop = loop
+        self.timeout = timeout
+
+    def _wait(self, coro):
+        return _wait(coro, self.loop, self.timeout)
+
+    def _read_head(self, size, line=False):
+        end = len(self.head) if size is None or size < 0 else size
+        if line:
+            newline = self.head.find(b'\n', 0, end)
+            if newline != -1:
+                end = newline + 1
+        data, self.head = self.head[:end], self.head[end:]
+        return data
+
+    def read(self, size=-1):
+        data = self._read_head(size)
+        if size is None or size < 0:
+            return data + self._wait(self.reader.read())
+
+        size -= len(data)
+        if size > 0:
+            try:
+                data += self._wait(self.reader.readexactly(size))
+            except asyncio.IncompleteReadError as e:
+                data += e.partial
+        return data
+
+    def readline(self, size=-1):
+        if self.head:
+            return self._read_head(size, line=True)
+        return self._wait(self.reader.readline())
+
+    def close(self):
+        pass
+
+
+class _StreamWriter(object):
+    """File-like writer over an asyncio stream, for handler threads.
+
+    Everything written is queued to be sent from the event loop, in order,
+    so handlers only wait on the client once more than MAX_BUFFERED bytes
+    are queued, for up to timeout seconds at a time. send_file hands a whole
+    file over to be sent from the loop, with its reads on executor.
+    """
+
+    def __init__(self, writer, loop, executor, timeout=None):
+        self.writer = writer
+        self.loop = loop
+        self.executor = executor
+        self.timeout = timeout
+        # Future of the last thing queued, which the next one waits for
+        self.last = None
+        self.error = None
+        self.buffered = 0
+        self.condition = threading.Condition()
+
+    def _queue(self, coro):
+        self.last = asyncio.run_coroutine_threadsafe(self._after(self.last, coro), self.loop)
+
+    async def _after(self, previous, coro):
+        if previous:
+            await asyncio.wait([asyncio.wrap_future(previous)])
+        try:
+            await coro
+        except Exception as e:
+            if not self.error:
+                logger.info('Failed sending response: %r', e)
+                # Whatever's been sent of the response can't be finished
+                self.writer.transport.abort()
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+            raise
+
+    def _check(self):
+        if self.error:
+            raise ConnectionError('Response not sent: %r' % self.error)
+
+    async def _drain(self):
+        try:
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout('timed out')
+
+    async def _write(self, data):
+        try:
+            self._check()
+            self.writer.write(data)
+        finally:
+            with self.condition:
+                self.buffered -= len(data)
+                self.condition.notify_all()
+        await self._drain()
+
+    async def _send_file(self, f, length):
+        try:
+            while length > 0:
+                self._check()
+                chunk = await self.loop.run_in_executor(self.executor, f.read, min(SEND_CHUNK_SIZE, length))
+                if not chunk:
+                    raise ConnectionError('File ended %s bytes short' % length)
+                self.writer.write(chunk)
+                length -= len(chunk)
+                await self._drain()
+        finally:
+            f.close()
+
+    def write(self, data):
+        data = bytes(data)
+        with self.condition:
+            self._check()
+            self.buffered += len(data)
+        self._queue(self._write(data))
+
+        with self.condition:
+            while self.buffered > MAX_BUFFERED and not self.error:
+                if not self.condition.wait(self.timeout):
+                    raise socket.timeout('timed out')
+            self._check()
+        return len(data)
+
+    def send_file(self, f, length):
+        """Send length bytes of f after everything written so far, then
+        close it."""
+        self._queue(self._send_file(f, length))
+
+    async def sent(self):
+        """Wait for everything queued to be sent, returning whether it was."""
+        if self.last:
+            await asyncio.wait([asyncio.wrap_future(self.last)])
+        return not self.error
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class AsyncHTTPServer(object):
+    """HTTP server that keeps connections on an asyncio event loop.
+
+    Idle and slow clients only cost a coroutine; each request is handed, once
+    its head has arrived, to a BaseHTTPRequestHandler subclass running in a
+    pool of worker threads, and file bodies it sends are sent from the loop.
+    Mirrors the HTTPServer interface used by main.
+    """
+
+    def __init__(self, server_address, RequestHandlerClass, workers=64, header_timeout=60):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.header_timeout = header_timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.ssl_context = None
+        self.loop = None
+
+        # Bind straight away, like HTTPServer does
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(1024)
+
+    def set_file_store(self, file_store):
+        self.file_store = file_store
+
+    def set_mock_hostname(self, mock_hostname):
+        self.mock_hostname = mock_hostname
+
+    def set_request_metrics(self, request_metrics):
+        self.request_metrics = request_metrics
+
+    def set_ssl_context(self, ssl_context):
+        self.ssl_context = ssl_context
+
+    def serve_forever(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(asyncio.start_server(
+            self._handle_connection,
+            sock=self.socket,
+            ssl=self.ssl_context,
+            limit=MAX_HEAD_SIZE,
+        ))
+        self.loop.run_forever()
+
+    def server_close(self):
+        self.socket.close()
+        self.executor.shutdown(wait=False)
+        if self.loop:
+            self.loop.close()
+
+    async def _handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        stream_writer = _StreamWriter(writer, self.loop, self.executor, self.RequestHandlerClass.timeout)
+        requests_handled = 0
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.header_timeout)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    break
+
+                requests_handled += 1
+                close_connection = await self.loop.run_in_executor(
+                    self.executor,
+                    self._handle_request,
+                    head,
+                    reader,
+                    stream_writer,
+                    client_address,
+                    requests_handled,
+                )
+                # The handler may have left a file body still being sent
+                if not await stream_writer.sent() or close_connection:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _handle_request(self, head, reader, stream_writer, client_address, requests_handled):
+        # Set up the handler by hand, as BaseRequestHandler.__init__ expects
+        # a socket and handles the request straight away
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.server = self
+        handler.request = None
+        handler.client_address = client_address
+        # Reads and writes time out like the threaded server's sockets do
+        handler.rfile = _StreamReader(head, reader, self.loop, handler.timeout)
+        handler.wfile = stream_writer
+        handler.close_connection = True
+        # Counted by handle_one_request, so one less than this request
+        handler.requests_handled = requests_handled - 1
+        try:
+            handler.handle_one_request()
+        except socket.timeout:
+            logger.info('Timed out handling request from %s', client_address)
+            # Unsent data would otherwise hold the connection open
+            self.loop.call_soon_threadsafe(stream_writer.writer.transport.abort)
+            return True
+        except ConnectionError as e:
+            logger.info('Lost connection to %s: %r', client_address, e)
+            return True
+        except Exception:
+            logger.exception('Error handling request from %s', client_address)
+            return True
+        return handler.close_connection
@@ -1,27 +1,291 @@
+from collections import OrderedDict
+import logging
 import os
+import tempfile
+import threading
+
+from .metrics import counter, gauge
+
+
+TMP_PREFIX = '.tmp-'
+
+logger = logging.getLogger(__name__)
+
+
+class CacheWriter(object):
+    """Incrementally write a file into the cache, keyed once it is complete.
+
+    Data goes to a temporary file which is atomically renamed into place on
+    commit, so readers never see a partially written file.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        fd, self.tmp_path = tempfile.mkstemp(dir=cache.cache_dir, prefix=TMP_PREFIX)
+        self.f = os.fdopen(fd, 'wb')
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        self.f.write(data)
+        self.size += len(data)
+
+    def write_at(self, offset, data):
+        """Write data at offset, unbuffered so readers of tmp_path see it at once.
+
+        Safe to call from several threads, but not to mix with write.
+        """
+        os.pwrite(self.f.fileno(), data, offset)
+        with self.lock:
+            self.size += len(data)
+
+    def commit(self, md5, sync=False):
+        if sync:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        self.f.close()
+        os.rename(self.tmp_path, self.cache._path(md5))
+        self.tmp_path = None
+        self.cache._add(md5, self.size)
+
+    def discard(self):
+        if self.tmp_path:
+            self.f.close()
+            os.remove(self.tmp_path)
+            self.tmp_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.discard()
 
 
 class Cache(object):
-    def __init__(self, cache_dir='/tmp'):
+    """Disk cache of file contents keyed by md5, bounded to max_size bytes.
+
+    The least recently used files are evicted once the cache grows past
+    max_size. A max_size of 0 disables eviction. Pinned files (such as ones
+    that haven't been uploaded to sia yet) are never evicted.
+    """
+
+    def __init__(self, cache_dir='/tmp', max_size=0, pinned=()):
         if not os.path.exists(cache_dir):
             os.mkdir(cache_dir)
 
         self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # md5 -> size, least recently used first
+        self.index = OrderedDict()
+        # md5 -> pin count
+        self.pins = {}
+        for md5 in pinned:
+            self.pin(md5)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._load_index()
+
+    def _path(self, md5):
+        return f'{self.cache_dir}/{md5}'
+
+    def _load_index(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.is_file():
+                continue
+
+            # Left over from writes interrupted by a crash
+            if entry.name.startswith(TMP_PREFIX):
+                os.remove(entry.path)
+                continue
+
+            stat = entry.stat()
+            entries.append((max(stat.st_atime, stat.st_mtime), entry.name, stat.st_size))
+
+        for _, md5, size in sorted(entries):
+            self.index[md5] = size
+            self.size += size
+        logger.info('Loaded %s files (%s bytes) into the file cache', len(self.index), self.size)
+
+        with self.lock:
+            self._evict()
+
+    def _add(self, md5, size):
+        with self.lock:
+            self.size += size - self.index.pop(md5, 0)
+            self.index[md5] = size
+            self._evict()
+
+    def _evict(self):
+        if not self.max_size or self.size <= self.max_size:
+            return
+
+        for md5 in list(self.index):
+            if self.size <= self.max_size:
+                break
+            if md5 in self.pins:
+                continue
+
+            self.size -= self.index.pop(md5)
+            self.evictions += 1
+            try:
+                os.remove(self._path(md5))
+            except FileNotFoundError:
+                pass
+
+    def pin(self, md5):
+        with self.lock:
+            self.pins[md5] = self.pins.get(md5, 0) + 1
+
+    def unpin(self, md5):
+        with self.lock:
+            self.pins[md5] -= 1
+            if not self.pins[md5]:
+                del self.pins[md5]
+            self._evict()
 
     def put(self, md5, data):
-        with open(f'{self.cache_dir}/{md5}', 'wb') as f:
+        with self.writer() as f:
             f.write(data)
+            f.commit(md5)
+
+    def writer(self):
+        return CacheWriter(self)
+
+    def contains(self, md5):
+        with self.lock:
+            return md5 in self.index
+
+    def open(self, md5):
+        """Return an open file for md5, or None if it isn't cached."""
+        with self.lock:
+            if md5 not in self.index:
+                self.misses += 1
+                return
+
+            self.index.move_to_end(md5)
+            self.hits += 1
+
+        try:
+            return open(self._path(md5), 'rb')
+        except FileNotFoundError:
+            # Removed from underneath us
+            with self.lock:
+                self.size -= self.index.pop(md5, 0)
+                self.hits -= 1
+                self.misses += 1
+            return
 
     def get(self, md5):
-        path = f'{self.cache_dir}/{md5}'
-        if not os.path.exists(path):
+        f = self.open(md5)
+        if not f:
             return
 
-        with open(path, 'rb') as f:
+        with f:
             return f.read()
 
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'files': len(self.index),
+                'size': self.size,
+                'max_size': self.max_size,
+                'pinned': len(self.pins),
+            }
+
+    def metrics(self):
+        stats = self.stats()
+        return _cache_metrics('s3_proxy_file_cache', 'file cache', stats) + [
+            gauge('s3_proxy_file_cache_pinned', 'Files pinned in the file cache until uploaded', stats['pinned']),
+        ]
+
+
+class MemoryCache(object):
+    """In-memory LRU cache of small, frequently read files keyed by md5.
+
+    Holds at most max_size bytes, and only files of max_item_size bytes or
+    less. A max_size of 0 disables the cache.
+    """
+
+    def __init__(self, max_size=0, max_item_size=1024 * 1024):
+        self.max_size = max_size
+        self.max_item_size = max_item_size
+        self.lock = threading.Lock()
+        # md5 -> data, least recently used first
+        self.index = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def accepts(self, size):
+        return self.max_size and size <= min(self.max_item_size, self.max_size)
+
+    def put(self, md5, data):
+        if not self.accepts(len(data)):
+            return
+
+        with self.lock:
+            old = self.index.pop(md5, None)
+            if old is not None:
+                self.size -= len(old)
+            self.index[md5] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                _, evicted = self.index.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def get(self, md5):
+        if not self.max_size:
+            return
+
+        with self.lock:
+            data = self.index.get(md5)
+            if data is None:
+                self.misses += 1
+                return
+
+            self.index.move_to_end(md5)
+            self.hits += 1
+            return data
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'evictions': self.evictions,
+                'files': len(self.index),
+                'size': self.size,
+                'max_size': self.max_size,
+            }
+
+    def metrics(self):
+        return _cache_metrics('s3_proxy_memory_cache', 'memory cache', self.stats())
+
+
+def _cache_metrics(prefix, name, stats):
+    return [
+        counter(f'{prefix}_hits_total', f'Lookups found in the {name}', stats['hits']),
+        counter(f'{prefix}_misses_total', f'Lookups not found in the {name}', stats['misses']),
+        counter(f'{prefix}_evictions_total', f'Files evicted from the {name}', stats['evictions']),
+        gauge(f'{prefix}_files', f'Files in the {name}', stats['files']),
+        gauge(f'{prefix}_size_bytes', f'Bytes in the {name}', stats['size']),
+        gauge(f'{prefix}_max_size_bytes', f'Maximum bytes in the {name}, 0 for no limit', stats['max_size']),
+    ]
+
 
 if __name__ == '__main__':
     c = Cache(cache_dir='/tmp/sia-s3-proxy-cache')
     c.put('iwjef', b'testtest')
     print(c.get('iwjef'))
+    print(c.stats())
@@ -0,0 +1,116 @@
+import heapq
+from operator import itemgetter
+import threading
+
+
+class _Listing(object):
+    """Directory listings for one walk, fetched by up to workers threads.
+
+    Paths are listed smallest first, which is the order the walk needs them
+    in, so listing ahead never holds up the directory being waited on.
+    """
+
+    def __init__(self, list_dir, workers):
+        self.list_dir = list_dir
+        self.workers = workers
+        self.lock = threading.Condition()
+        self.queue = []
+        self.requested = set()
+        self.results = {}
+        self.running = 0
+        self.stopped = False
+
+    def prefetch(self, paths):
+        with self.lock:
+            for path in paths:
+                if path not in self.requested:
+                    self.requested.add(path)
+                    heapq.heappush(self.queue, path)
+
+            while self.running < min(self.workers, len(self.queue)):
+                self.running += 1
+                threading.Thread(target=self._work, daemon=True).start()
+
+    def result(self, path):
+        self.prefetch([path])
+        with self.lock:
+            while path not in self.results:
+                self.lock.wait()
+            result, error = self.results.pop(path)
+
+        if error:
+            raise error
+        return result
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.queue = []
+            self.results = {}
+
+    def _work(self):
+        while True:
+            with self.lock:
+                if not self.queue:
+                    self.running -= 1
+                    return
+                path = heapq.heappop(self.queue)
+
+            result, error = None, None
+            try:
+                result = self.list_dir(path)
+            except Exception as e:
+                error = e
+
+            with self.lock:
+                if not self.stopped:
+                    self.results[path] = (result, error)
+                    self.lock.notify_all()
+
+
+class DirWalker(object):
+    """Walks a directory tree in lexicographic key order.
+
+    list_dir(path) returns (files, directories), where files is a list of
+    (key, details) and directories a list of paths ending in '/'. All the
+    subdirectories found are listed ahead in parallel, by up to workers
+    threads, while the walk works through them in order.
+    """
+
+    def __init__(self, list_dir, workers=8):
+        self.list_dir = list_dir
+        self.workers = workers
+
+    def walk(self, path, recursive=True, start_after=''):
+        """Yield (key, details) for each file under path.
+
+        If recursive is False subdirectories aren't walked, and are yielded
+        as (path, None) instead. Only keys after start_after are yielded,
+        and directories that can't contain any aren't listed, so resuming a
+        walk only costs listing the directories on the way back to it.
+        Close the generator to stop early.
+        """
+        listing = _Listing(self.list_dir, self.workers)
+        try:
+            yield from self._walk(listing, path, recursive, start_after)
+        finally:
+            listing.stop()
+
+    def _walk(self, listing, path, recursive, start_after):
+        files, directories = listing.result(path)
+        if recursive:
+            # Skip directories whose keys all sort before start_after
+            directories = [
+                directory for directory in directories
+                if directory > start_after or start_after.startswith(directory)
+            ]
+            listing.prefetch(directories)
+
+        # A directory's keys all sort straight after its path, which ends
+        # in '/', so sorting them in with the files keeps the walk in order
+        entries = files + [(directory, None) for directory in directories]
+        for key, details in sorted(entries, key=itemgetter(0)):
+            if details is None and recursive:
+                yield from self._walk(listing, key, recursive, start_after)
+            elif key > start_after:
+                yield key, details
@@ -25,6 +25,33 @@ class BucketNotEmpty(Exception):
         return '%s, %s' % (self.http_status, self.message)
 
 
+class NoSuchUpload(Exception):
+    def __init__(self):
+        self.message = 'The specified multipart upload does not exist'
+        self.http_status = '404'
+
+    def __str__(self):
+        return '%s, %s' % (self.http_status, self.message)
+
+
+class InvalidPart(Exception):
+    def __init__(self):
+        self.message = 'One or more of the specified parts could not be found'
+        self.http_status = '400'
+
+    def __str__(self):
+        return '%s, %s' % (self.http_status, self.message)
+
+
+class SlowDown(Exception):
+    def __init__(self):
+        self.message = 'Please reduce your request rate'
+        self.http_status = '503'
+
+    def __str__(self):
+        return '%s, %s' % (self.http_status, self.message)
+
+
 class HttpError(Exception):
     def __init__(self, status_code, response):
         self.status_code = status_code
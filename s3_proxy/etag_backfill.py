@@ -0,0 +1,61 @@
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class EtagBackfill(object):
+    """Background job filling in etags that listings found missing.
+
+    Keys are queued with add(bucket, key) and handed one at a time to
+    fill(bucket, key), which returns the number of bytes it had to read.
+    It's throttled to rate bytes per second so it doesn't starve requests
+    of sia bandwidth.
+    """
+
+    def __init__(self, fill, rate=10 * 1024 ** 2, max_pending=10000):
+        self.fill = fill
+        self.rate = rate
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # Ordered, so keys are filled in the order they were seen
+        self.pending = {}
+
+    def start(self):
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def add(self, bucket, key):
+        with self.lock:
+            if len(self.pending) >= self.max_pending:
+                # Dropped, it'll be queued again next time it's listed
+                return
+            self.pending[(bucket, key)] = True
+        self.wakeup.set()
+
+    def _next(self):
+        with self.lock:
+            if not self.pending:
+                self.wakeup.clear()
+                return None
+            bucket_key = next(iter(self.pending))
+            del self.pending[bucket_key]
+            return bucket_key
+
+    def _work(self):
+        while True:
+            bucket_key = self._next()
+            if not bucket_key:
+                self.wakeup.wait()
+                continue
+
+            try:
+                size = self.fill(*bucket_key)
+            except Exception:
+                logger.exception('Failed to fill in etag for %s/%s', *bucket_key)
+                continue
+
+            if size:
+                time.sleep(size / self.rate)
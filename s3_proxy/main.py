@@ -2,20 +2,101 @@ import logging
 import os
 import ssl
 import sys
+import time
 import urllib.parse
 import xml.etree.ElementTree as ET
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
 
-from s3_proxy.actions import delete_item, delete_items, get_acl, get_item, list_buckets, ls_bucket
+from s3_proxy.actions import (
+    abort_multipart_upload,
+    complete_multipart_upload,
+    copy_item,
+    create_multipart_upload,
+    delete_item,
+    delete_items,
+    get_acl,
+    get_item,
+    health,
+    list_buckets,
+    list_parts,
+    ls_bucket,
+    metrics,
+    not_implemented,
+    slow_down,
+    upload_part,
+)
+from s3_proxy.async_server import AsyncHTTPServer
+from s3_proxy.errors import SlowDown
 from s3_proxy.file_store import FileStore
+from s3_proxy.metrics import CountingFile, RequestMetrics
 from s3_proxy.sia_store import SiaStore
 
 
 logging.basicConfig(level=logging.INFO)
 
+# Not valid bucket names, so they can't hide one
+HEALTH_PATH = '/_health'
+METRICS_PATH = '/_metrics'
+
 
 class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Seconds an idle keep-alive connection is held open for
+    timeout = 60
+    # Requests served on a connection before it's closed, 0 for no limit
+    max_requests = 100
+
+    def handle_one_request(self):
+        self.requests_handled = getattr(self, 'requests_handled', 0) + 1
+        request_metrics = self.server.request_metrics
+        if not isinstance(self.rfile, CountingFile):
+            self.rfile = CountingFile(self.rfile, request_metrics.received_bytes)
+            self.wfile = CountingFile(self.wfile, request_metrics.sent_bytes)
+
+        # Set once the request has been read, and by the do_ methods
+        self.request_start = None
+        self.operation = None
+        self.status = None
+        try:
+            super().handle_one_request()
+        except SlowDown:
+            # eg siad couldn't be reached, which is only worth answering if
+            # nothing has been sent yet
+            if self.status is not None:
+                raise
+            slow_down(self)
+            # The request body may not have been read
+            self.close_connection = True
+        finally:
+            if self.request_start is not None:
+                operation = self.operation or 'other'
+                request_metrics.in_flight.dec()
+                request_metrics.seconds.observe(time.monotonic() - self.request_start, operation)
+                request_metrics.requests.inc(operation, self.status or 0)
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        self.request_start = time.monotonic()
+        self.server.request_metrics.in_flight.inc()
+        return True
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+        if self.max_requests and self.requests_handled >= self.max_requests:
+            self.send_header('Connection', 'close')
+
+    def _discard_body(self):
+        """Read and ignore the request body, so the connection can be reused."""
+        size = int(self.headers.get('content-length', 0))
+        while size > 0:
+            data = self.rfile.read(min(size, 64 * 1024))
+            if not data:
+                break
+            size -= len(data)
+
     def do_GET(self, content=True):
         parsed_path = urllib.parse.urlparse(self.path)
         qs = urllib.parse.parse_qs(parsed_path.query, True)
@@ -33,6 +114,12 @@ class S3Handler(BaseHTTPRequestHandler):
         if path == '/' and not bucket_name:
             req_type = 'list_buckets'
 
+        elif path == HEALTH_PATH and not bucket_name:
+            req_type = 'health'
+
+        elif path == METRICS_PATH and not bucket_name:
+            req_type = 'metrics'
+
         else:
             if not bucket_name:
                 bucket_name, sep, item_name = path.strip('/').partition('/')
@@ -44,14 +131,23 @@ class S3Handler(BaseHTTPRequestHandler):
             elif not item_name:
                 req_type = 'ls_bucket'
             else:
-                if 'acl' in qs and qs['acl'] == '':
+                if 'acl' in qs and qs['acl'] == ['']:
                     req_type = 'get_acl'
+                elif 'uploadId' in qs:
+                    req_type = 'list_parts'
                 else:
                     req_type = 'get'
 
+        self.operation = 'head' if req_type == 'get' and not content else req_type
         if req_type == 'list_buckets':
             list_buckets(self)
 
+        elif req_type == 'health':
+            health(self)
+
+        elif req_type == 'metrics':
+            metrics(self)
+
         elif req_type == 'ls_bucket':
             ls_bucket(self, bucket_name, qs)
 
@@ -61,8 +157,11 @@ class S3Handler(BaseHTTPRequestHandler):
         elif req_type == 'get':
             get_item(self, bucket_name, item_name, content=content)
 
+        elif req_type == 'list_parts':
+            list_parts(self, bucket_name, item_name, qs['uploadId'][0])
+
         else:
-            self.wfile.write('%s: [%s] %s' % (req_type, bucket_name, item_name))
+            not_implemented(self)
 
     def do_DELETE(self):
         parsed_path = urllib.parse.urlparse(self.path)
@@ -82,10 +181,14 @@ class S3Handler(BaseHTTPRequestHandler):
         else:
             item_name = path.strip('/')
 
-        if bucket_name and item_name:
+        if bucket_name and item_name and 'uploadId' in qs:
+            self.operation = 'abort_multipart_upload'
+            return abort_multipart_upload(self, bucket_name, item_name, qs['uploadId'][0])
+        elif bucket_name and item_name:
+            self.operation = 'delete'
             delete_item(self, bucket_name, item_name)
         else:
-            self.wfile.write('%s: [%s] %s' % ('DELETE', bucket_name, item_name))
+            return not_implemented(self)
 
         self.send_response(204)
         self.send_header('Content-Length', '0')
@@ -119,17 +222,40 @@ class S3Handler(BaseHTTPRequestHandler):
 
             if not item_name and 'delete' in qs:
                 req_type = 'delete_keys'
+            elif item_name and 'uploads' in qs:
+                req_type = 'create_multipart_upload'
+            elif item_name and 'uploadId' in qs:
+                req_type = 'complete_multipart_upload'
 
+        self.operation = req_type
         if req_type == 'delete_keys':
             size = int(self.headers['content-length'])
             data = self.rfile.read(size)
             root = ET.fromstring(data)
             keys = []
-            for obj in root.findall('Object'):
-                keys.append(obj.find('Key').text)
-            delete_items(self, bucket_name, keys)
+            quiet = False
+            for element in root:
+                if _local_name(element.tag) == 'Object':
+                    fields = dict((_local_name(child.tag), child.text) for child in element)
+                    keys.append(fields['Key'])
+                elif _local_name(element.tag) == 'Quiet':
+                    quiet = (element.text or '').strip().lower() == 'true'
+            delete_items(self, bucket_name, keys, quiet)
+        elif req_type == 'create_multipart_upload':
+            create_multipart_upload(self, bucket_name, item_name)
+        elif req_type == 'complete_multipart_upload':
+            size = int(self.headers['content-length'])
+            data = self.rfile.read(size)
+            root = ET.fromstring(data)
+            parts = []
+            for part in root.iter():
+                if _local_name(part.tag) == 'Part':
+                    fields = dict((_local_name(child.tag), child.text) for child in part)
+                    parts.append((int(fields['PartNumber']), fields['ETag']))
+            complete_multipart_upload(self, bucket_name, item_name, qs['uploadId'][0], parts)
         else:
-            self.wfile.write('%s: [%s] %s' % (req_type, bucket_name, item_name))
+            self._discard_body()
+            not_implemented(self)
 
     def do_PUT(self):
         parsed_path = urllib.parse.urlparse(self.path)
@@ -141,7 +267,6 @@ class S3Handler(BaseHTTPRequestHandler):
         req_type = None
 
         mock_hostname = self.server.mock_hostname
-        print(host)
         if host != mock_hostname and mock_hostname in host:
             idx = host.index(mock_hostname)
             bucket_name = host[:idx-1]
@@ -158,20 +283,31 @@ class S3Handler(BaseHTTPRequestHandler):
             if not item_name:
                 req_type = 'create_bucket'
             else:
-                if 'acl' in qs and qs['acl'] == '':
+                if 'acl' in qs and qs['acl'] == ['']:
                     req_type = 'set_acl'
+                elif 'uploadId' in qs and 'partNumber' in qs:
+                    req_type = 'upload_part'
                 else:
                     req_type = 'store'
 
         if 'x-amz-copy-source' in self.headers:
-            copy_source = self.headers['x-amz-copy-source']
-            src_bucket, sep, src_key = copy_source.partition('/')
-            req_type = 'copy'
+            # /bucket/key, URL encoded, optionally with ?versionId=
+            copy_source = self.headers['x-amz-copy-source'].partition('?')[0]
+            src_bucket, sep, src_key = urllib.parse.unquote(copy_source).lstrip('/').partition('/')
+            # Copying into a multipart upload part isn't supported
+            req_type = 'copy' if req_type == 'store' else None
 
+        self.operation = req_type
         if req_type == 'create_bucket':
+            self._discard_body()
             self.server.file_store.create_bucket(bucket_name)
             self.send_response(200)
 
+        elif req_type == 'set_acl':
+            # ACLs aren't supported, so accept and ignore them
+            self._discard_body()
+            self.send_response(200)
+
         elif req_type == 'store':
             bucket = self.server.file_store.get_bucket(bucket_name)
             if not bucket:
@@ -181,15 +317,27 @@ class S3Handler(BaseHTTPRequestHandler):
             self.send_response(200)
             self.send_header('Etag', '"%s"' % item.md5)
 
+        elif req_type == 'upload_part':
+            return upload_part(self, bucket_name, item_name, qs['uploadId'][0], int(qs['partNumber'][0]))
+
         elif req_type == 'copy':
-            self.server.file_store.copy_item(src_bucket, src_key, bucket_name, item_name, self)
-            # TODO: should be some xml here
-            self.send_response(200)
+            self._discard_body()
+            return copy_item(self, src_bucket, src_key, bucket_name, item_name)
+
+        else:
+            self._discard_body()
+            return not_implemented(self)
 
         self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
 
+def _local_name(tag):
+    """Strip any namespace from an ElementTree tag."""
+    return tag.rpartition('}')[2]
+
+
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     def set_file_store(self, file_store):
         self.file_store = file_store
@@ -197,6 +345,9 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     def set_mock_hostname(self, mock_hostname):
         self.mock_hostname = mock_hostname
 
+    def set_request_metrics(self, request_metrics):
+        self.request_metrics = request_metrics
+
 
 def main(argv=sys.argv[1:]):
     bind = os.environ.get('BIND', '0.0.0.0')
@@ -207,9 +358,35 @@ def main(argv=sys.argv[1:]):
     sia_password = os.environ.get('SIA_PASSWORD')
     sia_host = os.environ.get('SIA_HOST', 'localhost')
     sia_port = int(os.environ.get('SIA_PORT', 9980))
+    sia_pool_size = int(os.environ.get('SIA_POOL_SIZE', 10))
+    sia_connect_timeout = float(os.environ.get('SIA_CONNECT_TIMEOUT', 5))
+    sia_read_timeout = float(os.environ.get('SIA_READ_TIMEOUT', 300))
+    sia_retries = int(os.environ.get('SIA_RETRIES', 3))
+    sia_keep_alive = os.environ.get('SIA_KEEP_ALIVE', 'true') == 'true'
+    sia_list_cache_ttl = float(os.environ.get('SIA_LIST_CACHE_TTL', 30))
     cache_dir = os.environ.get('CACHE_DIR', './').rstrip('/')
-
-    server = ThreadedHTTPServer((bind, port), S3Handler)
+    cache_size = int(os.environ.get('CACHE_SIZE', 10 * 1024 ** 3))
+    memory_cache_size = int(os.environ.get('MEMORY_CACHE_SIZE', 0))
+    memory_cache_item_size = int(os.environ.get('MEMORY_CACHE_ITEM_SIZE', 1024 ** 2))
+    write_back = os.environ.get('WRITE_BACK', 'false') == 'true'
+    upload_workers = int(os.environ.get('UPLOAD_WORKERS', 4))
+    etag_backfill_rate = int(os.environ.get('ETAG_BACKFILL_RATE', 10 * 1024 ** 2))
+    list_workers = int(os.environ.get('LIST_WORKERS', 8))
+    delete_workers = int(os.environ.get('DELETE_WORKERS', 8))
+    bucket_refresh_interval = float(os.environ.get('BUCKET_REFRESH_INTERVAL', 300))
+    range_chunk_size = int(os.environ.get('RANGE_CHUNK_SIZE', 8 * 1024 ** 2))
+    read_ahead_chunks = int(os.environ.get('READ_AHEAD_CHUNKS', 2))
+    download_segment_size = int(os.environ.get('DOWNLOAD_SEGMENT_SIZE', 64 * 1024 ** 2))
+    download_workers = int(os.environ.get('DOWNLOAD_WORKERS', 4))
+    server_engine = os.environ.get('SERVER_ENGINE', 'threaded')
+    async_workers = int(os.environ.get('ASYNC_WORKERS', 64))
+    S3Handler.timeout = int(os.environ.get('KEEP_ALIVE_TIMEOUT', 60))
+    S3Handler.max_requests = int(os.environ.get('KEEP_ALIVE_MAX_REQUESTS', 100))
+
+    if server_engine == 'async':
+        server = AsyncHTTPServer((bind, port), S3Handler, workers=async_workers, header_timeout=S3Handler.timeout)
+    else:
+        server = ThreadedHTTPServer((bind, port), S3Handler)
     # server.set_file_store(FileStore(args.root))
     server.set_file_store(SiaStore(
         root,
@@ -217,9 +394,33 @@ def main(argv=sys.argv[1:]):
         port=sia_port,
         password=sia_password,
         cache_dir=cache_dir,
+        cache_size=cache_size,
+        memory_cache_size=memory_cache_size,
+        memory_cache_item_size=memory_cache_item_size,
+        write_back=write_back,
+        upload_workers=upload_workers,
+        etag_backfill_rate=etag_backfill_rate,
+        list_workers=list_workers,
+        delete_workers=delete_workers,
+        bucket_refresh_interval=bucket_refresh_interval,
+        range_chunk_size=range_chunk_size,
+        read_ahead_chunks=read_ahead_chunks,
+        download_segment_size=download_segment_size,
+        download_workers=download_workers,
+        pool_size=sia_pool_size,
+        connect_timeout=sia_connect_timeout,
+        read_timeout=sia_read_timeout,
+        retries=sia_retries,
+        keep_alive=sia_keep_alive,
+        list_cache_ttl=sia_list_cache_ttl,
     ))
     server.set_mock_hostname(host)
-    if https:
+    server.set_request_metrics(RequestMetrics())
+    if https and server_engine == 'async':
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(certfile="/tmp/cert.pem", keyfile="/tmp/key.pem")
+        server.set_ssl_context(ssl_context)
+    elif https:
         server.socket = ssl.wrap_socket(server.socket,
             keyfile="/tmp/key.pem",
             certfile="/tmp/cert.pem",
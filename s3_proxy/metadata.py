@@ -0,0 +1,174 @@
+from collections import OrderedDict
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# source is the siapath of an object's contents when they aren't stored at
+# its own path, because it's a copy of another object
+FIELDS = ('etag', 'size', 'modified_date', 'content_type', 'state', 'source')
+
+# Upload states
+PENDING = 'pending'  # Waiting in the write back queue
+UPLOADING = 'uploading'  # Sent to sia, but not available for download yet
+AVAILABLE = 'available'
+
+
+class MetadataIndex(object):
+    """Durable index of object metadata, keyed by bucket and key.
+
+    Records are dicts of FIELDS, any of which may be None if unknown. Rows
+    live in SQLite (in WAL mode, committed on every change so nothing is lost
+    in a crash), with an in-memory front for reads of the most recently used
+    max_records.
+    """
+
+    def __init__(self, path, max_records=100000):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS objects (
+                bucket TEXT NOT NULL,
+                key TEXT NOT NULL,
+                etag TEXT,
+                size INTEGER,
+                modified_date TEXT,
+                content_type TEXT,
+                state TEXT,
+                source TEXT,
+                PRIMARY KEY (bucket, key)
+            ) WITHOUT ROWID
+        ''')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(objects)')]
+        if 'source' not in columns:
+            self.db.execute('ALTER TABLE objects ADD COLUMN source TEXT')
+        self.db.execute('CREATE INDEX IF NOT EXISTS objects_source ON objects (source)')
+        # So listing copies only visits copies, not every object after the marker
+        self.db.execute('CREATE INDEX IF NOT EXISTS objects_copies ON objects (bucket, key) WHERE source IS NOT NULL')
+        self.db.commit()
+        # (bucket, key) -> record, or None if it's not in the index, least
+        # recently used first
+        self.records = OrderedDict()
+        self.max_records = max_records
+
+    def get(self, bucket, key):
+        with self.lock:
+            record = self._get(bucket, key)
+            return dict(record) if record else None
+
+    def _get(self, bucket, key):
+        """Get a record, which mustn't be modified, with lock held."""
+        if (bucket, key) in self.records:
+            self.records.move_to_end((bucket, key))
+            return self.records[(bucket, key)]
+
+        row = self.db.execute(
+            'SELECT %s FROM objects WHERE bucket = ? AND key = ?' % ', '.join(FIELDS),
+            (bucket, key),
+        ).fetchone()
+        record = dict(zip(FIELDS, row)) if row else None
+        self._remember(bucket, key, record)
+        return record
+
+    def _remember(self, bucket, key, record):
+        self.records[(bucket, key)] = record
+        self.records.move_to_end((bucket, key))
+        while len(self.records) > self.max_records:
+            self.records.popitem(last=False)
+
+    def put(self, bucket, key, **fields):
+        """Update the given fields of a record, creating it if necessary."""
+        # Under one lock, so concurrent updates of different fields don't
+        # overwrite each other
+        with self.lock:
+            record = dict(self._get(bucket, key) or dict.fromkeys(FIELDS))
+            if all(record[field] == value for field, value in fields.items()):
+                return record
+
+            record.update(fields)
+            self.db.execute(
+                'INSERT OR REPLACE INTO objects (bucket, key, %s) VALUES (?, ?, %s)' % (
+                    ', '.join(FIELDS),
+                    ', '.join('?' * len(FIELDS)),
+                ),
+                (bucket, key) + tuple(record[field] for field in FIELDS),
+            )
+            self.db.commit()
+            self._remember(bucket, key, record)
+            return dict(record)
+
+    def delete(self, bucket, key):
+        with self.lock:
+            self.db.execute('DELETE FROM objects WHERE bucket = ? AND key = ?', (bucket, key))
+            self.db.commit()
+            self._remember(bucket, key, None)
+
+    def delete_many(self, bucket, keys):
+        """Delete the records of keys in bucket, in one transaction."""
+        with self.lock:
+            self.db.executemany(
+                'DELETE FROM objects WHERE bucket = ? AND key = ?',
+                [(bucket, key) for key in keys],
+            )
+            self.db.commit()
+            for key in keys:
+                self._remember(bucket, key, None)
+
+    def references(self, source):
+        """List the (bucket, key)s of objects whose contents are at source."""
+        with self.lock:
+            return self.db.execute('SELECT bucket, key FROM objects WHERE source = ?', (source,)).fetchall()
+
+    def copies(self, bucket, prefix='', start_after='', batch_size=1000):
+        """Yield (key, record) for the copies in bucket, in key order."""
+        while True:
+            with self.lock:
+                rows = self.db.execute(
+                    'SELECT key, %s FROM objects WHERE bucket = ? AND source IS NOT NULL AND key > ? AND key >= ? '
+                    'ORDER BY key LIMIT ?' % ', '.join(FIELDS),
+                    (bucket, start_after, prefix, batch_size),
+                ).fetchall()
+
+            for row in rows:
+                if not row[0].startswith(prefix):
+                    return
+                yield row[0], dict(zip(FIELDS, row[1:]))
+
+            if len(rows) < batch_size:
+                return
+            start_after = rows[-1][0]
+
+    def import_md5_cache(self, path):
+        """Import etags from the md5 cache used by older versions.
+
+        That was a pickledb file, which is JSON of "bucket/key": md5. It's
+        renamed once imported so this only happens once.
+        """
+        if not os.path.exists(path):
+            return
+
+        with open(path) as f:
+            md5s = json.load(f)
+
+        with self.lock:
+            for bucket_key, md5 in md5s.items():
+                bucket, _, key = bucket_key.partition('/')
+                self.db.execute(
+                    'INSERT OR IGNORE INTO objects (bucket, key, etag) VALUES (?, ?, ?)',
+                    (bucket, key, md5),
+                )
+            self.db.commit()
+            self.records.clear()
+
+        os.rename(path, f'{path}.imported')
+        logger.info('Imported %s etags from %s', len(md5s), path)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
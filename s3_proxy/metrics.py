@@ -0,0 +1,172 @@
+import threading
+
+
+# Upper bounds, in seconds, of latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Metric(object):
+    """A metric in the Prometheus text format, with a value for each
+    combination of label values it's been given."""
+
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        # Tuple of label values -> value
+        self.values = {}
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines.extend(self._samples(label_values, value))
+        return lines
+
+    def _samples(self, label_values, value):
+        return [f'{self.name}{_labels(self.labels, label_values)} {_number(value)}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            # Count in each bucket, then the total count and sum
+            counts = self.values.setdefault(label_values, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += 1
+            counts[-1] += value
+
+    def _samples(self, label_values, counts):
+        labels = self.labels + ('le',)
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            samples.append(f'{self.name}_bucket{_labels(labels, label_values + (_number(bound),))} {cumulative}')
+        samples.append(f'{self.name}_bucket{_labels(labels, label_values + ("+Inf",))} {counts[-2]}')
+        samples.append(f'{self.name}_sum{_labels(self.labels, label_values)} {_number(counts[-1])}')
+        samples.append(f'{self.name}_count{_labels(self.labels, label_values)} {counts[-2]}')
+        return samples
+
+
+class RequestMetrics(object):
+    """Metrics of the S3 requests handled by the server."""
+
+    def __init__(self):
+        self.seconds = Histogram(
+            's3_proxy_request_seconds',
+            'Time taken to handle S3 requests, by operation',
+            ('operation',),
+        )
+        self.requests = Counter(
+            's3_proxy_requests_total',
+            'S3 requests handled, by operation and response status',
+            ('operation', 'status'),
+        )
+        self.in_flight = Gauge('s3_proxy_requests_in_flight', 'S3 requests being handled')
+        self.in_flight.set(0)
+        self.received_bytes = Counter('s3_proxy_received_bytes_total', 'Bytes received from S3 clients')
+        self.received_bytes.inc(amount=0)
+        self.sent_bytes = Counter('s3_proxy_sent_bytes_total', 'Bytes sent to S3 clients')
+        self.sent_bytes.inc(amount=0)
+
+    def metrics(self):
+        return [self.seconds, self.requests, self.in_flight, self.received_bytes, self.sent_bytes]
+
+
+class CountingFile(object):
+    """Wraps a file, counting the bytes read from or written to it with
+    counter."""
+
+    def __init__(self, f, counter):
+        self.f = f
+        self.counter = counter
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.counter.inc(amount=len(data))
+        return data
+
+    def readline(self, size=-1):
+        data = self.f.readline(size)
+        self.counter.inc(amount=len(data))
+        return data
+
+    def write(self, data):
+        self.counter.inc(amount=len(data))
+        return self.f.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def counter(name, help, value):
+    """A counter with the single value given, for exposing existing counts."""
+    metric = Counter(name, help)
+    metric.inc(amount=value)
+    return metric
+
+
+def gauge(name, help, value):
+    """A gauge with the single value given."""
+    metric = Gauge(name, help)
+    metric.set(value)
+    return metric
+
+
+def render(metrics):
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+    return '{%s}' % pairs
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(value) if isinstance(value, float) else str(value)
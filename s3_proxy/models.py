@@ -5,11 +5,20 @@ class Bucket(object):
 
 
 class BucketQuery(object):
-    def __init__(self, bucket, matches=[], is_truncated=False, common_prefixes=[], **kwargs):
+    def __init__(self, bucket, matches=[], is_truncated=False, common_prefixes=[], next_marker=None, entries=None,
+                 **kwargs):
         self.bucket = bucket
         self.matches = matches
         self.common_prefixes = common_prefixes
         self.is_truncated = is_truncated
+        # Last key or common prefix listed, if truncated
+        self.next_marker = next_marker
+        # Generator of (key, S3Item) for matches and (prefix, None) for
+        # common prefixes. Stores may list lazily, only setting is_truncated
+        # and next_marker once it's been exhausted.
+        if entries is None:
+            entries = (entry for entry in [(item.key, item) for item in matches] + [(p, None) for p in common_prefixes])
+        self.entries = entries
         self.marker = kwargs['marker']
         self.prefix = kwargs['prefix']
         self.max_keys = kwargs['max_keys']
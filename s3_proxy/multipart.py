@@ -0,0 +1,147 @@
+from datetime import datetime
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import uuid
+
+from .errors import InvalidPart, NoSuchUpload
+
+
+META_FILE = 'upload.json'
+
+
+class Part(object):
+    def __init__(self, part_number, md5, size, modified_date):
+        self.part_number = part_number
+        self.md5 = md5
+        self.size = size
+        self.modified_date = modified_date
+
+
+class MultipartUploads(object):
+    """Stages the parts of multipart uploads on local disk.
+
+    Each upload gets its own directory under staging_dir, holding the parts
+    as they arrive (so they can be received concurrently) until the upload
+    is completed or aborted.
+    """
+
+    def __init__(self, staging_dir):
+        if not os.path.exists(staging_dir):
+            os.makedirs(staging_dir)
+
+        self.staging_dir = staging_dir
+
+    def _upload_dir(self, upload_id):
+        # Upload ids come from clients, so make sure they're one of ours
+        try:
+            upload_id = uuid.UUID(hex=upload_id).hex
+        except ValueError:
+            raise NoSuchUpload()
+
+        path = f'{self.staging_dir}/{upload_id}'
+        if not os.path.exists(path):
+            raise NoSuchUpload()
+        return path
+
+    def _part_files(self, upload_dir):
+        """Return a dict of part number -> (md5, path) for the staged parts."""
+        parts = {}
+        for name in os.listdir(upload_dir):
+            part_number, sep, md5 = name.partition('.')
+            if part_number.isdigit() and sep:
+                parts[int(part_number)] = (md5, f'{upload_dir}/{name}')
+        return parts
+
+    def create(self, bucket_name, item_name, content_type=None):
+        upload_id = uuid.uuid4().hex
+        path = f'{self.staging_dir}/{upload_id}'
+        os.mkdir(path)
+        with open(f'{path}/{META_FILE}', 'w') as f:
+            json.dump({
+                'bucket': bucket_name,
+                'key': item_name,
+                'content_type': content_type,
+                'initiated': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            }, f)
+        return upload_id
+
+    def get(self, upload_id):
+        with open(f'{self._upload_dir(upload_id)}/{META_FILE}') as f:
+            return json.load(f)
+
+    def store_part(self, upload_id, part_number, chunks):
+        upload_dir = self._upload_dir(upload_id)
+        if not 1 <= part_number <= 10000:
+            raise InvalidPart()
+
+        # Parts are named <part number>.<md5> so they never need rehashing
+        m = hashlib.md5()
+        fd, tmp_path = tempfile.mkstemp(dir=upload_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    m.update(chunk)
+                    f.write(chunk)
+            md5 = m.hexdigest()
+            previous = self._part_files(upload_dir).get(part_number)
+            os.rename(tmp_path, f'{upload_dir}/{part_number:05d}.{md5}')
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        # Replace any earlier upload of the same part
+        if previous and previous[0] != md5:
+            os.remove(previous[1])
+
+        return md5
+
+    def list_parts(self, upload_id):
+        parts = []
+        for part_number, (md5, path) in sorted(self._part_files(self._upload_dir(upload_id)).items()):
+            stat = os.stat(path)
+            parts.append(Part(
+                part_number,
+                md5,
+                stat.st_size,
+                datetime.utcfromtimestamp(stat.st_mtime).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            ))
+        return parts
+
+    def assemble(self, upload_id, parts, chunk_size=1024 * 1024):
+        """Check the completed parts and return (etag, size, chunks).
+
+        parts is a list of (part_number, etag) pairs, as sent by the client.
+        chunks iterates over the contents of the parts in order.
+        """
+        upload_dir = self._upload_dir(upload_id)
+        part_numbers = [part_number for part_number, _ in parts]
+        if not parts or part_numbers != sorted(set(part_numbers)):
+            raise InvalidPart()
+
+        part_files = self._part_files(upload_dir)
+        paths = []
+        digests = b''
+        size = 0
+        for part_number, etag in parts:
+            md5, path = part_files.get(part_number, (None, None))
+            if not md5 or md5 != etag.strip('"'):
+                raise InvalidPart()
+
+            paths.append(path)
+            digests += bytes.fromhex(md5)
+            size += os.path.getsize(path)
+
+        def chunks():
+            for path in paths:
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(chunk_size), b''):
+                        yield chunk
+
+        etag = '%s-%s' % (hashlib.md5(digests).hexdigest(), len(parts))
+        return etag, size, chunks()
+
+    def remove(self, upload_id):
+        shutil.rmtree(self._upload_dir(upload_id), ignore_errors=True)
@@ -0,0 +1,59 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReadAhead(object):
+    """Prefetches the chunks of an object after the ones being read in order.
+
+    Reads are reported with read(key, index, count, *args), where index is
+    the chunk read and count the number of chunks in the object. Once a key
+    is read sequentially (each chunk being the same as or the one after the
+    last), fetch(*args, i) is called in the background for the next chunks
+    chunks. Only the most recently read max_keys keys are tracked.
+    """
+
+    def __init__(self, fetch, chunks=2, workers=4, max_keys=1000):
+        self.fetch = fetch
+        self.chunks = chunks
+        self.max_keys = max_keys
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        # key -> last chunk read, least recently read first
+        self.last = OrderedDict()
+        # (key, chunk) for prefetches queued or running
+        self.queued = set()
+
+    def read(self, key, index, count, *args):
+        if not self.chunks:
+            return
+
+        with self.lock:
+            last = self.last.pop(key, None)
+            self.last[key] = index
+            while len(self.last) > self.max_keys:
+                self.last.popitem(last=False)
+            if last is None or index not in (last, last + 1):
+                return
+
+            indexes = [
+                i for i in range(index + 1, min(index + 1 + self.chunks, count))
+                if (key, i) not in self.queued
+            ]
+            self.queued.update((key, i) for i in indexes)
+
+        for i in indexes:
+            self.executor.submit(self._fetch, key, i, args)
+
+    def _fetch(self, key, index, args):
+        try:
+            self.fetch(*args, index)
+        except Exception as e:
+            logger.warning('Failed to read ahead chunk %s of %s: %s', index, key, e)
+        finally:
+            with self.lock:
+                self.queued.discard((key, index))
@@ -0,0 +1,255 @@
+import hashlib
+import logging
+import os
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+# Size of the pieces downloaded data is hashed in
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class SharedDownload(object):
+    """Download of a whole file from sia into the file cache, which any
+    number of readers can follow as the bytes arrive.
+
+    The file can be downloaded as one stream, or in segments by several
+    threads at once, each writing into the cache file at its offset. Readers
+    only ever see the part of the file from the start that's complete.
+
+    The download runs in its own threads so a slow reader doesn't hold up
+    the rest, and is abandoned if every reader closes before it's done. Once
+    complete the cache file is committed under md5 (calculated from the
+    contents if it isn't known), and on_complete is called with it.
+    on_finish is called when it's over either way.
+    """
+
+    def __init__(self, cache_file, size, md5=None, on_complete=None, on_finish=None):
+        self.cache_file = cache_file
+        self.size = size
+        self.md5 = md5
+        self.on_complete = on_complete
+        self.on_finish = on_finish
+        self.cond = threading.Condition()
+        # Readers get their own copy of this, and read with pread, so they
+        # can keep reading after the file has been renamed into the cache
+        self.fd = os.open(cache_file.tmp_path, os.O_RDONLY)
+        self.m = hashlib.md5()
+        self.hash_lock = threading.Lock()
+        self.hashed = 0
+        self.fetch_range = None
+        # (start, end) inclusive, and bytes downloaded so far, of each segment
+        self.segments = []
+        self.progress = []
+        self.next_segment = 0
+        self.first_incomplete = 0
+        self.workers = 0
+        self.resps = []
+        self.started = False
+        # Bytes complete from the start of the file
+        self.written = 0
+        self.readers = 0
+        self.abandoned = False
+        self.done = False
+        self.error = None
+
+    def start(self, chunks, resp, fetch_range=None, segment_size=0, workers=1):
+        """Start downloading from resp, which iterates over chunks.
+
+        With fetch_range, resp is only the first segment_size bytes of the
+        file, and the rest are fetched in segments by workers threads with
+        fetch_range(start, end), which also returns (chunks, resp).
+        """
+        if fetch_range:
+            self.fetch_range = fetch_range
+            self.segments = [
+                (start, min(start + segment_size, self.size) - 1)
+                for start in range(0, self.size, segment_size)
+            ]
+        else:
+            workers = 1
+            self.segments = [(0, self.size - 1)]
+
+        with self.cond:
+            self.progress = [0] * len(self.segments)
+            self.next_segment = 1
+            self.workers = min(workers, len(self.segments))
+            self.resps.append(resp)
+            self.started = True
+            self.cond.notify_all()
+
+        threading.Thread(target=self._work, args=(0, chunks, resp), daemon=True).start()
+        for _ in range(self.workers - 1):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def fail(self, error):
+        """Give up on a download that couldn't be started."""
+        self.cache_file.discard()
+        self._finish(error)
+
+    def wait_started(self):
+        with self.cond:
+            while not self.started and not self.done:
+                self.cond.wait()
+            if not self.started:
+                raise self.error
+
+    def reader(self):
+        """Return a new reader, or None if it's too late to follow the download."""
+        with self.cond:
+            if self.fd is None or self.abandoned:
+                return None
+            self.readers += 1
+            return SharedDownloadReader(self, os.dup(self.fd))
+
+    def _release(self):
+        with self.cond:
+            self.readers -= 1
+            # Once it's all downloaded it may as well be cached
+            if self.readers or self.done or self.written == self.size:
+                return
+            self.abandoned = True
+            resps = list(self.resps)
+
+        # Wake the download threads up if they're waiting on sia
+        for resp in resps:
+            resp.close()
+
+    def _work(self, index=None, chunks=None, resp=None):
+        try:
+            while True:
+                if chunks is None:
+                    with self.cond:
+                        if self.abandoned or self.error or self.next_segment >= len(self.segments):
+                            break
+                        index = self.next_segment
+                        self.next_segment += 1
+
+                    chunks, resp = self.fetch_range(*self.segments[index])
+                    with self.cond:
+                        self.resps.append(resp)
+
+                try:
+                    self._download_segment(index, chunks)
+                finally:
+                    resp.close()
+                chunks = None
+        except Exception as e:
+            with self.cond:
+                self.error = self.error or e
+                self.cond.notify_all()
+        finally:
+            with self.cond:
+                self.workers -= 1
+                last = not self.workers
+            if last:
+                self._complete()
+
+    def _download_segment(self, index, chunks):
+        start, end = self.segments[index]
+        offset = start
+        for chunk in chunks:
+            if self.abandoned or self.error:
+                return
+            # Whole file responses are cut down to the segment
+            chunk = chunk[:end + 1 - offset]
+            self.cache_file.write_at(offset, chunk)
+            offset += len(chunk)
+            with self.cond:
+                self.progress[index] = offset - start
+                self._advance()
+            self._hash()
+            if offset > end:
+                break
+
+        if offset <= end:
+            raise IOError(f'Segment {index} ended after {offset - start} of {end - start + 1} bytes')
+
+    def _advance(self):
+        """Move written on past the segments that are now complete."""
+        while self.first_incomplete < len(self.segments):
+            start, end = self.segments[self.first_incomplete]
+            if self.progress[self.first_incomplete] < end - start + 1:
+                break
+            self.first_incomplete += 1
+
+        if self.first_incomplete < len(self.segments):
+            self.written = self.segments[self.first_incomplete][0] + self.progress[self.first_incomplete]
+        else:
+            self.written = self.size
+        self.cond.notify_all()
+
+    def _hash(self):
+        """Hash the complete part of the file that hasn't been yet."""
+        if self.md5:
+            return
+
+        with self.hash_lock:
+            while self.hashed < self.written:
+                data = os.pread(self.fd, min(HASH_CHUNK_SIZE, self.written - self.hashed), self.hashed)
+                self.m.update(data)
+                self.hashed += len(data)
+
+    def _complete(self):
+        error = self.error
+        try:
+            if self.abandoned:
+                self.cache_file.discard()
+            elif error:
+                raise error
+            elif self.written < self.size:
+                raise IOError(f'Download ended after {self.written} of {self.size} bytes')
+            else:
+                self._hash()
+                md5 = self.md5 or self.m.hexdigest()
+                self.cache_file.commit(md5)
+                self.on_complete(md5)
+        except Exception as e:
+            if not self.abandoned:
+                logger.exception('Failed to download file from sia')
+            self.cache_file.discard()
+            error = e
+        finally:
+            self._finish(error)
+
+    def _finish(self, error):
+        if self.on_finish:
+            self.on_finish()
+        with self.cond:
+            self.done = True
+            self.error = error
+            os.close(self.fd)
+            self.fd = None
+            self.cond.notify_all()
+
+
+class SharedDownloadReader(object):
+    """File-like reader following a SharedDownload from the start."""
+
+    def __init__(self, download, fd):
+        self.download = download
+        self.fd = fd
+        self.offset = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            return b''.join(iter(lambda: self.read(1024 * 1024), b''))
+
+        download = self.download
+        with download.cond:
+            while self.offset >= download.written and self.offset < download.size and not download.done:
+                download.cond.wait()
+            available = download.written - self.offset
+            if available <= 0 and self.offset < download.size:
+                raise IOError('Download from sia failed') from download.error
+
+        data = os.pread(self.fd, min(size, available), self.offset)
+        self.offset += len(data)
+        return data
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.download._release()
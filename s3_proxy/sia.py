@@ -1,50 +1,331 @@
+from collections import OrderedDict
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.util.retry import Retry
+
 from .errors import HttpError
+from .metrics import Counter, Histogram, counter, gauge
 
 USER_AGENT = 'Sia-Agent'
 
+# What siad says, depending on its version, about paths that don't exist
+NOT_FOUND_MESSAGES = ('path does not exist', 'no file known with that path', 'no siadir known with that path')
+
+# Seconds a request has to wait for a pooled connection to count as a wait
+POOL_WAIT_THRESHOLD = 0.001
+
+
+class SiaStats(object):
+    """Counters for sizing the connection pool against siad, and request
+    latencies by endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Until the response headers arrive, so streams aren't timed to the end
+        self.request_seconds = Histogram(
+            's3_proxy_sia_request_seconds',
+            'Time taken for siad to respond, by endpoint and method',
+            ('endpoint', 'method'),
+        )
+        self.errors = Counter(
+            's3_proxy_sia_errors_total',
+            'Requests to siad that failed, by endpoint and status, 0 if there was no response',
+            ('endpoint', 'status'),
+        )
+        self.requests = 0
+        self.in_flight = 0
+        self.pool_waits = 0
+        self.pool_wait_seconds = 0
+        self.max_pool_wait_seconds = 0
+
+    def record_pool_wait(self, seconds):
+        with self.lock:
+            if seconds >= POOL_WAIT_THRESHOLD:
+                self.pool_waits += 1
+            self.pool_wait_seconds += seconds
+            self.max_pool_wait_seconds = max(self.max_pool_wait_seconds, seconds)
+
+    def metrics(self):
+        stats = self.as_dict()
+        return [
+            self.request_seconds,
+            self.errors,
+            counter('s3_proxy_sia_requests_total', 'Requests made to siad', stats['requests']),
+            gauge('s3_proxy_sia_requests_in_flight', 'Requests to siad waiting for a response', stats['in_flight']),
+            counter('s3_proxy_sia_pool_waits_total', 'Requests that had to wait for a free connection to siad',
+                    stats['pool_waits']),
+            counter('s3_proxy_sia_pool_wait_seconds_total', 'Time spent waiting for connections to siad',
+                    stats['pool_wait_seconds']),
+        ]
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'in_flight': self.in_flight,
+                'pool_waits': self.pool_waits,
+                'pool_wait_seconds': self.pool_wait_seconds,
+                'max_pool_wait_seconds': self.max_pool_wait_seconds,
+            }
+
+
+class ListingCache(object):
+    """Cache of siad directory listings, keyed by path.
+
+    Listings expire after ttl seconds, and are invalidated as soon as a
+    change is made through the client, so only changes made to the renter
+    by something else can go unseen for up to ttl. A ttl of 0 disables it.
+    """
+
+    def __init__(self, ttl=30, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # path -> (expiry time, listing), least recently used first
+        self.entries = OrderedDict()
+        # Bumped by every invalidation, so listings fetched before one
+        # aren't cached after it
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, path):
+        if not self.ttl:
+            return None
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if not entry or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(path)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, path, listing, generation):
+        if not self.ttl:
+            return
+
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[path] = (time.monotonic() + self.ttl, listing)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, path, subtree=False):
+        """Drop the listings of path and the directories above it.
+
+        With subtree the listings of everything below path are dropped too.
+        """
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            parts = path.split('/')
+            for i in range(len(parts) + 1):
+                self.entries.pop('/'.join(parts[:i]), None)
+
+            if subtree:
+                for cached in list(self.entries):
+                    if cached.startswith(path + '/'):
+                        del self.entries[cached]
+
+    def metrics(self):
+        stats = self.stats()
+        return [
+            counter('s3_proxy_sia_list_cache_hits_total', 'Directory listings served from the cache', stats['hits']),
+            counter('s3_proxy_sia_list_cache_misses_total', 'Directory listings fetched from siad', stats['misses']),
+            counter('s3_proxy_sia_list_cache_invalidations_total', 'Invalidations of cached directory listings',
+                    stats['invalidations']),
+            gauge('s3_proxy_sia_list_cache_entries', 'Directory listings cached', stats['entries']),
+        ]
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+            }
+
+
+def _timed_pool_class(stats):
+    """Return a connection pool class recording how long requests wait for a connection."""
+
+    class TimedConnectionPool(HTTPConnectionPool):
+        def _get_conn(self, timeout=None):
+            start = time.monotonic()
+            conn = super()._get_conn(timeout)
+            stats.record_pool_wait(time.monotonic() - start)
+            return conn
+
+    return TimedConnectionPool
+
+
+def _retry(retries):
+    """Retry idempotent requests, with whichever keyword the installed
+    urllib3 takes for the methods to retry (allowed_methods from 1.26)."""
+    methods_keyword = 'allowed_methods' if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS') else 'method_whitelist'
+    return Retry(
+        total=retries,
+        read=0,
+        status=0,
+        backoff_factor=0.5,
+        raise_on_status=False,
+        **{methods_keyword: frozenset(['GET'])}
+    )
+
 
 class Sia(object):
-    def __init__(self, host='127.0.0.1', port=9980, password=''):
+    """Client for the siad API, safe to share between threads.
+
+    Each thread gets its own requests session, but they share one pool of at
+    most pool_size connections to siad; threads wait for a free connection
+    once it's exhausted. Uploads, which hold their connection for as long as
+    the client takes to send the body, have a pool of their own that opens
+    extra connections rather than waiting. Idempotent requests are retried
+    on connection errors. Directory listings are cached for list_cache_ttl
+    seconds.
+    """
+
+    def __init__(self, host='127.0.0.1', port=9980, password='', pool_size=10, connect_timeout=5,
+                 read_timeout=300, retries=3, keep_alive=True, list_cache_ttl=30):
         self.host = host
         self.port = port
-        self.s = requests.Session()
-        self.s.auth = ("", password)
-
-    def _request(self, path, action='get', **kwargs):
-        func = getattr(self.s, action)
-        resp = func(
-            f'http://{self.host}:{self.port}{path}',
-            headers={'User-Agent': USER_AGENT},
-            **kwargs,
+        self.password = password
+        self.timeout = (connect_timeout, read_timeout)
+        self.keep_alive = keep_alive
+        self.stats = SiaStats()
+        self.list_cache = ListingCache(list_cache_ttl)
+
+        self.adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=_retry(retries),
+        )
+        self.adapter.poolmanager.pool_classes_by_scheme = {'http': _timed_pool_class(self.stats)}
+        self.upload_adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            pool_block=False,
+            max_retries=_retry(retries),
         )
+        self.local = threading.local()
+
+    @property
+    def s(self):
+        return self._session('session', self.adapter)
+
+    @property
+    def upload_session(self):
+        return self._session('upload_session', self.upload_adapter)
+
+    def _session(self, name, adapter):
+        session = getattr(self.local, name, None)
+        if not session:
+            session = requests.Session()
+            session.auth = ("", self.password)
+            session.mount('http://', adapter)
+            setattr(self.local, name, session)
+        return session
+
+    def _request(self, path, action='get', session=None, **kwargs):
+        func = getattr(session or self.s, action)
+        headers = kwargs.pop('headers', {})
+        headers['User-Agent'] = USER_AGENT
+        if not self.keep_alive:
+            headers['Connection'] = 'close'
+
+        # eg /renter/stream, without the siapath
+        endpoint = '/'.join(path.partition('?')[0].split('/')[:3])
+        with self.stats.lock:
+            self.stats.requests += 1
+            self.stats.in_flight += 1
+        start = time.monotonic()
+        try:
+            resp = func(
+                f'http://{self.host}:{self.port}{path}',
+                headers=headers,
+                timeout=self.timeout,
+                **kwargs,
+            )
+        except Exception:
+            self.stats.errors.inc(endpoint, 0)
+            raise
+        finally:
+            self.stats.request_seconds.observe(time.monotonic() - start, endpoint, action.upper())
+            with self.stats.lock:
+                self.stats.in_flight -= 1
 
-        if resp.status_code not in [200, 204]:
+        if resp.status_code not in [200, 204, 206]:
+            self.stats.errors.inc(endpoint, resp.status_code)
             raise HttpError(resp.status_code, resp.text)
 
         return resp
 
-    def list(self, path):
-        return self._request(f'/renter/dir/{path}').json()
+    def list(self, path, fresh=False):
+        """List a directory. The result is shared, so mustn't be modified.
+
+        With fresh, siad is asked even if the listing is cached.
+        """
+        path = path.strip('/')
+        listing = None if fresh else self.list_cache.get(path)
+        if listing is None:
+            generation = self.list_cache.generation
+            listing = self._request(f'/renter/dir/{path}').json()
+            self.list_cache.put(path, listing, generation)
+        return listing
 
     def create_folder(self, path):
-        return self._request(
-            f'/renter/dir/{path}/?action=create',
-            action='post',
-        )
+        try:
+            return self._request(
+                f'/renter/dir/{path}/?action=create',
+                action='post',
+            )
+        finally:
+            self.list_cache.invalidate(path.strip('/'))
 
     def delete_folder(self, path):
-        return self._request(
-            f'/renter/dir/{path}/?action=delete',
-            action='post',
-        )
+        try:
+            return self._request(
+                f'/renter/dir/{path}/?action=delete',
+                action='post',
+            )
+        finally:
+            self.list_cache.invalidate(path.strip('/'), subtree=True)
 
     def upload_file(self, path, data):
-        return self._request(
-            f'/renter/uploadstream/{path}/?force=true',
-            action='post',
-            data=data,
-        )
+        try:
+            return self._request(
+                f'/renter/uploadstream/{path}/?force=true',
+                action='post',
+                session=self.upload_session,
+                data=data,
+            )
+        finally:
+            self.list_cache.invalidate(path.strip('/'))
+
+    def rename_file(self, path, new_path):
+        try:
+            return self._request(
+                f'/renter/rename/{path}',
+                action='post',
+                data={'newsiapath': new_path},
+            )
+        finally:
+            self.list_cache.invalidate(path.strip('/'))
+            self.list_cache.invalidate(new_path.strip('/'))
 
     def get_file_status(self, path):
         return self._request(f'/renter/file/{path}').json()['file']
@@ -52,11 +333,49 @@ class Sia(object):
     def get_file(self, path):
         return self._request(f'/renter/stream/{path}').content
 
+    def stream_file(self, path, chunk_size=1024 * 1024, start=None, end=None):
+        """Return an iterator over the file's contents and the response.
+
+        If start is given only bytes start-end (inclusive, end defaulting to
+        the end of the file) are returned. The response should be closed if
+        the iterator isn't exhausted.
+        """
+        headers = {}
+        if start is not None:
+            headers['Range'] = 'bytes=%s-%s' % (start, '' if end is None else end)
+
+        resp = self._request(f'/renter/stream/{path}', headers=headers, stream=True)
+        chunks = resp.iter_content(chunk_size)
+        if start is not None and resp.status_code == 200:
+            # The range was ignored, so skip to it ourselves
+            chunks = _slice_chunks(chunks, start, end)
+        return chunks, resp
+
     def delete_file(self, path):
-        return self._request(
-            f'/renter/delete/{path}',
-            action='post'
-        )
+        try:
+            return self._request(
+                f'/renter/delete/{path}',
+                action='post'
+            )
+        finally:
+            self.list_cache.invalidate(path.strip('/'))
+
+
+def is_not_found(error):
+    """Whether error is siad saying the path doesn't exist."""
+    return isinstance(error, HttpError) and any(message in error.response for message in NOT_FOUND_MESSAGES)
+
+
+def _slice_chunks(chunks, start, end):
+    offset = 0
+    for chunk in chunks:
+        chunk_start = offset
+        offset += len(chunk)
+        if offset <= start:
+            continue
+        if end is not None and chunk_start > end:
+            return
+        yield chunk[max(start - chunk_start, 0):None if end is None else end - chunk_start + 1]
 
 
 if __name__ == '__main__':
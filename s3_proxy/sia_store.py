@@ -1,35 +1,269 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextlib
 from datetime import datetime
+import functools
 import hashlib
+import heapq
 import io
-import pickledb
+import json
+import logging
+from operator import itemgetter
+import os
+import threading
 import time
+import uuid
 
-from .cache import Cache
-from .errors import BucketNotEmpty, NoSuchBucket, NoSuchKey, HttpError
+from .cache import Cache, MemoryCache
+from .dir_walker import DirWalker
+from .errors import BucketNotEmpty, NoSuchBucket, NoSuchKey, NoSuchUpload, HttpError, SlowDown
+from .etag_backfill import EtagBackfill
+from .metadata import AVAILABLE, PENDING, UPLOADING, MetadataIndex
+from .metrics import Counter, gauge
 from .models import Bucket, BucketQuery, S3Item
-from .sia import Sia
+from .multipart import MultipartUploads
+from .read_ahead import ReadAhead
+from .shared_download import SharedDownload
+from .sia import Sia, is_not_found
+from .single_flight import SingleFlight
+from .upload_queue import UploadQueue
+from .upload_tracker import FileMissing, UploadTracker
+
+
+logger = logging.getLogger(__name__)
+
+# Size of the pieces request bodies are read and uploaded in
+CHUNK_SIZE = 1024 * 1024
+
+# Directory under base_dir that the contents of deleted or overwritten
+# objects are moved to while copies still refer to them. Bucket names can't
+# start with a dot, so it can't clash with one.
+SHARED_DIR = '.shared'
+
+# Directory under base_dir that uploads are streamed into, and renamed out
+# of once the whole body has arrived
+UPLOADS_DIR = '.uploads'
+
+
+class SiaReader(object):
+    """File-like reader over a streamed download of part of a file from sia."""
+
+    def __init__(self, chunks, resp, size):
+        self.chunks = chunks
+        self.resp = resp
+        self.remaining = size
+        self.buffer = b''
+        self.done = False
+
+    def _fill(self):
+        chunk = next(self.chunks, None) if self.remaining > 0 else None
+        if chunk is None:
+            self.done = True
+            return
+
+        self.buffer += chunk
+        self.remaining -= len(chunk)
+        if self.remaining <= 0:
+            self._fill()
+
+    def read(self, size=-1):
+        if size < 0:
+            while not self.done:
+                self._fill()
+        elif not self.buffer and not self.done:
+            self._fill()
+
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.resp.close()
+
+
+class ChunkReader(object):
+    """File-like reader over bytes start-end (inclusive) of an object, read a
+    chunk at a time with get_chunk(index)."""
+
+    def __init__(self, get_chunk, chunk_size, start, end):
+        self.get_chunk = get_chunk
+        self.chunk_size = chunk_size
+        self.offset = start
+        self.end = end
+        self.buffer = b''
+
+    def read(self, size=-1):
+        if size < 0:
+            return b''.join(iter(lambda: self.read(CHUNK_SIZE), b''))
+
+        if not self.buffer and self.offset <= self.end:
+            index = self.offset // self.chunk_size
+            skip = self.offset - index * self.chunk_size
+            self.buffer = self.get_chunk(index)[skip:skip + self.end - self.offset + 1]
+            if not self.buffer:
+                raise IOError(f'Chunk {index} is short')
+            self.offset += len(self.buffer)
+
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        pass
 
 
 class SiaStore(object):
-    def __init__(self, base_dir, host='localhost', port=9980, password='', cache_dir='.'):
-        self.sia = Sia(host=host, port=port, password=password)
+    def __init__(self, base_dir, host='localhost', port=9980, password='', cache_dir='.', cache_size=0,
+                 memory_cache_size=0, memory_cache_item_size=1024 * 1024, write_back=False, upload_workers=4,
+                 etag_backfill_rate=10 * 1024 ** 2, list_workers=8, delete_workers=8, bucket_refresh_interval=300,
+                 range_chunk_size=8 * 1024 ** 2, read_ahead_chunks=2, download_segment_size=64 * 1024 ** 2,
+                 download_workers=4, **sia_options):
+        # sia_options are passed through to Sia, for tuning its connection pool
+        self.sia = Sia(host=host, port=port, password=password, **sia_options)
         self.base_dir = base_dir
-        self.buckets = self.get_all_buckets()
-        self.md5_cache = pickledb.load(f'{cache_dir}/md5-cache.db', False)
-        self.file_cache = Cache(cache_dir=f'{cache_dir}/file_cache')
+        self.cache_dir = cache_dir
+        self.metadata = MetadataIndex(f'{cache_dir}/metadata.db')
+
+        # Buckets start out as they were last seen, so requests can be served
+        # without waiting for siad, and are refreshed in the background. ready
+        # is set once they've been listed from siad.
+        self.buckets_lock = threading.Lock()
+        self.buckets_path = f'{cache_dir}/buckets.json'
+        self.buckets = self._load_buckets()
+        self.bucket_refresh_interval = bucket_refresh_interval
+        self.ready = threading.Event()
+        self.refresh_error = None
+        self.list_workers = list_workers
+        self.delete_workers = delete_workers
+        # Concurrent requests for a file that isn't cached share one status
+        # lookup and one download from sia, keyed by siapath
+        self.status_lookups = SingleFlight()
+        self.downloads_lock = threading.Lock()
+        self.downloads = {}
+        # Files bigger than download_segment_size are downloaded in segments
+        # of that size, download_workers at a time
+        self.download_segment_size = download_segment_size
+        self.download_workers = download_workers
+
+        # Range requests of objects with known md5s are read from sia, and
+        # cached, in chunks of range_chunk_size. Sequential reads of an
+        # object prefetch the read_ahead_chunks after the one being read.
+        self.range_chunk_size = range_chunk_size
+        self.chunk_fetches = SingleFlight()
+        self.read_ahead = ReadAhead(self._prefetch_chunk, chunks=read_ahead_chunks)
+        # Held while changing which objects share contents
+        self.copy_lock = threading.Lock()
+        # siapaths in UPLOADS_DIR of uploads in progress, so leftovers from
+        # before a restart can be told apart
+        self.uploads_lock = threading.Lock()
+        self.uploads = set()
+
+        # Uploads waiting to become available for download in sia, which
+        # need a fresh listing to see
+        self.upload_tracker = UploadTracker(self._list_uploads)
+        self.upload_tracker.start()
+
+        # With write back enabled, stores return once the data is in the
+        # file cache and are uploaded to sia in the background
+        self.upload_queue = None
+        pinned = []
+        if write_back:
+            self.upload_queue = UploadQueue(
+                f'{cache_dir}/upload_queue',
+                self._upload_job,
+                self._upload_job_complete,
+                workers=upload_workers,
+            )
+            pinned = [job['md5'] for job in self.upload_queue.pending()]
+
+        self.file_cache = Cache(cache_dir=f'{cache_dir}/file_cache', max_size=cache_size, pinned=pinned)
+        self.memory_cache = MemoryCache(memory_cache_size, memory_cache_item_size)
+        self.multipart_uploads = MultipartUploads(f'{cache_dir}/multipart')
+
+        if self.upload_queue:
+            self.upload_queue.start()
+
+        # Etags that listings find missing are filled in in the background,
+        # as that means downloading the whole file
+        self.etag_misses = Counter('s3_proxy_etag_misses_total', 'Objects looked up whose md5 isn\'t known')
+        self.etag_misses.inc(amount=0)
+        self.etag_backfill = None
+        if etag_backfill_rate:
+            self.etag_backfill = EtagBackfill(self._backfill_etag, rate=etag_backfill_rate)
+            self.etag_backfill.start()
+
+        threading.Thread(target=self._refresh, daemon=True).start()
 
     def _pre_exit(self):
-        self.md5_cache.dump()
+        self.metadata.close()
 
-    def _md5(self, bucket_name, key, retrieve_on_miss=True):
-        """Get md5 from cache, otherwise retrieve file and recalculate."""
-        md5 = self.md5_cache.get(f'{bucket_name}/{key}')
+    def metrics(self):
+        """Return the store's metrics, for the metrics endpoint."""
+        metrics = (
+            self.sia.stats.metrics()
+            + self.sia.list_cache.metrics()
+            + self.file_cache.metrics()
+            + self.memory_cache.metrics()
+        )
+        metrics.append(self.etag_misses)
+        metrics.append(gauge(
+            's3_proxy_uploads_pending',
+            'Uploads waiting in the write back queue',
+            len(self.upload_queue.pending()) if self.upload_queue else 0,
+        ))
+        metrics.append(gauge(
+            's3_proxy_uploads_unavailable',
+            'Uploads waiting to become available for download in sia',
+            self.upload_tracker.pending(),
+        ))
+        metrics.append(gauge('s3_proxy_ready', 'Whether buckets have been listed from siad', int(self.ready.is_set())))
+        return metrics
+
+    def _etag(self, bucket_name, key):
+        """Get md5 from the metadata index, queueing it to be filled in if it's missing."""
+        record = self.metadata.get(bucket_name, key)
+        md5 = record and record['etag']
 
-        if not md5 and retrieve_on_miss:
-            md5 = self.get_item(bucket_name, key).md5
+        if not md5:
+            self.etag_misses.inc()
+            if self.etag_backfill:
+                self.etag_backfill.add(bucket_name, key)
 
         return md5
 
+    def _backfill_etag(self, bucket_name, key):
+        """Hash a file in sia so its md5 gets recorded, returning bytes read.
+
+        It's streamed straight from sia rather than through the file cache,
+        so the backfill doesn't push out the files clients are reading.
+        """
+        record = self.metadata.get(bucket_name, key)
+        if record and record['etag']:
+            return 0
+
+        try:
+            md5, size = self._hash_file(self._sia_path(bucket_name, key, record))
+        except HttpError as e:
+            if e.status_code == 400 or is_not_found(e):
+                return 0
+            raise
+
+        # Unless it's been replaced, or hashed some other way, since
+        record = self.metadata.get(bucket_name, key)
+        if not (record and record['etag']):
+            self.metadata.put(bucket_name, key, etag=md5)
+        return size
+
+    def _hash_file(self, path):
+        """Get the md5 and size of a file in sia, without caching it."""
+        m = hashlib.md5()
+        size = 0
+        chunks, resp = self.sia.stream_file(path, CHUNK_SIZE)
+        with contextlib.closing(resp):
+            for chunk in chunks:
+                m.update(chunk)
+                size += len(chunk)
+        return m.hexdigest(), size
+
     def get_all_buckets(self):
         buckets = []
 
@@ -41,20 +275,103 @@ class SiaStore(object):
 
             # Use modified time since created isn't available
             create_date = datetime.strptime(directory['mostrecentmodtime'][:-4], '%Y-%m-%dT%H:%M:%S.%f')
-            path = directory['siapath'].lstrip(f'{self.base_dir}/')
+            path = directory['siapath'][len(f'{self.base_dir}/'):]
+            if path.startswith('.'):
+                # Not a bucket, eg SHARED_DIR
+                continue
             buckets.append(Bucket(path, create_date))
 
         return buckets
 
+    def refresh_buckets(self):
+        """List buckets from sia, saving them for the next startup."""
+        buckets = self.get_all_buckets()
+        with self.buckets_lock:
+            self.buckets = buckets
+            self._save_buckets()
+
+    def _load_buckets(self):
+        try:
+            with open(self.buckets_path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return []
+        except ValueError:
+            logger.warning('Ignoring corrupt bucket snapshot %s', self.buckets_path)
+            return []
+
+        buckets = []
+        for bucket in snapshot:
+            create_date = datetime.strptime(bucket['creation_date'], '%Y-%m-%dT%H:%M:%S.%f')
+            buckets.append(Bucket(bucket['name'], create_date))
+        logger.info('Loaded %s buckets from %s', len(buckets), self.buckets_path)
+        return buckets
+
+    def _save_buckets(self):
+        snapshot = [
+            {'name': bucket.name, 'creation_date': bucket.creation_date.strftime('%Y-%m-%dT%H:%M:%S.%f')}
+            for bucket in self.buckets
+        ]
+        tmp_path = f'{self.buckets_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.buckets_path)
+
+    def _refresh(self):
+        """Bring the state loaded at startup up to date, and keep it that way."""
+        try:
+            self.metadata.import_md5_cache(f'{self.cache_dir}/md5-cache.db')
+        except Exception:
+            logger.exception('Failed to import md5 cache')
+
+        delay = 1
+        while True:
+            try:
+                self.refresh_buckets()
+            except Exception as e:
+                # siad may still be starting up
+                self.refresh_error = str(e)
+                logger.warning('Failed to list buckets from sia, retrying in %ss: %s', delay, e)
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+                continue
+
+            self.refresh_error = None
+            delay = 1
+            if not self.ready.is_set():
+                logger.info('Listed %s buckets from sia', len(self.buckets))
+                self.ready.set()
+                try:
+                    self._clean_uploads()
+                except Exception:
+                    logger.exception('Failed to clean up leftover uploads')
+            if not self.bucket_refresh_interval:
+                return
+            time.sleep(self.bucket_refresh_interval)
+
     def get_bucket(self, bucket_name):
+        bucket = self._find_bucket(bucket_name)
+        if not bucket and not self.ready.is_set():
+            # It may be newer than the snapshot
+            try:
+                self.refresh_buckets()
+            except Exception as e:
+                # There's no knowing until siad answers, which the background
+                # refresh will keep trying for
+                logger.warning('Failed to list buckets from sia looking for %s: %s', bucket_name, e)
+                raise SlowDown()
+            bucket = self._find_bucket(bucket_name)
+        return bucket
+
+    def _find_bucket(self, bucket_name):
         for bucket in self.buckets:
             if bucket.name == bucket_name:
                 return bucket
 
     def create_bucket(self, bucket_name):
-        if bucket_name not in [bucket.name for bucket in self.buckets]:
+        if not self.get_bucket(bucket_name):
             self.sia.create_folder(f'{self.base_dir}/{bucket_name}')
-            self.buckets = self.get_all_buckets()
+            self.refresh_buckets()
 
         return self.get_bucket(bucket_name)
 
@@ -63,51 +380,300 @@ class SiaStore(object):
         if not bucket:
             raise NoSuchBucket()
 
+        # Copies aren't in the bucket's directory
+        if next(self.metadata.copies(bucket_name), None):
+            raise BucketNotEmpty()
+
         try:
             self.sia.delete_folder(f'{self.base_dir}/{bucket_name}')
         except:
             raise BucketNotEmpty()
 
-    def _block_until_uploaded(self, bucket_name, item_name, timeout_seconds=60):
-        uploaded = False
-        attempts = 0
-        key = f'{self.base_dir}/{bucket_name}/{item_name}'
-        while not uploaded:
-            uploaded = self.sia.get_file_status(key)['available']
-            time.sleep(1)
-            attempts += 1
-            if attempts > timeout_seconds:
-                raise Exception("File failed to fully upload")
-
-    def store_data(self, bucket, item_name, headers, data):
-        print(f'starting store for {item_name}')
+        with self.buckets_lock:
+            self.buckets = [bucket for bucket in self.buckets if bucket.name != bucket_name]
+            self._save_buckets()
+
+    def store_data(self, bucket, item_name, headers, data, etag=None):
+        """Upload data to sia, hashing and caching it as it streams through.
+
+        data may be bytes or an iterable of bytes chunks. If etag is given
+        it's recorded instead of the md5 of the data.
+        """
+        logger.debug('Starting store for %s', item_name)
+        if isinstance(data, bytes):
+            data = [data]
+
+        content_type = headers.get('content-type', 'application/octet-stream')
+        if self.upload_queue:
+            return self._store_data_write_back(bucket, item_name, content_type, data, etag)
+
         m = hashlib.md5()
-        m.update(data)
-        key = f'{self.base_dir}/{bucket.name}/{item_name}'
+        with self.file_cache.writer() as cache_file:
+            def chunks():
+                for chunk in data:
+                    if not etag:
+                        m.update(chunk)
+                    cache_file.write(chunk)
+                    yield chunk
 
-        md5 = m.hexdigest()
-        self.md5_cache.set(f'{bucket.name}/{item_name}', md5)
+            upload_path = self._upload(chunks())
+            md5 = etag or m.hexdigest()
+            cache_file.commit(md5)
 
-        self.sia.upload_file(key, data)
-        self.file_cache.put(md5, data)
+        # Under the same lock as the rename, so concurrent stores of the same
+        # key leave the metadata matching the contents that won
+        with self.copy_lock:
+            try:
+                self._place_upload(upload_path, bucket.name, item_name)
+            except Exception:
+                # Whatever was there before may be gone too
+                self.metadata.delete(bucket.name, item_name)
+                raise
+            self.metadata.put(
+                bucket.name,
+                item_name,
+                etag=md5,
+                size=cache_file.size,
+                modified_date=datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                content_type=content_type,
+                state=UPLOADING,
+            )
+
+        self.upload_tracker.track(f'{self.base_dir}/{bucket.name}/{item_name}').add_done_callback(
+            functools.partial(self._uploaded, bucket.name, item_name, md5)
+        )
         return S3Item(item_name, md5=md5)
 
+    def _upload(self, data):
+        """Upload data into UPLOADS_DIR, returning its siapath there.
+
+        Uploads don't go straight to the object's path, as siad deletes what's
+        there before the upload starts, and it could still fail part way
+        through. Once it's all arrived it's moved into place with
+        _place_upload.
+        """
+        upload_path = f'{self.base_dir}/{UPLOADS_DIR}/{uuid.uuid4().hex}'
+        with self.uploads_lock:
+            self.uploads.add(upload_path)
+        try:
+            self.sia.upload_file(upload_path, data)
+        except Exception:
+            self._discard_upload(upload_path)
+            raise
+        return upload_path
+
+    def _place_upload(self, upload_path, bucket_name, item_name):
+        """Move an upload to an object's path, replacing its contents.
+
+        If that fails the upload is deleted. Called with copy_lock held.
+        """
+        path = f'{self.base_dir}/{bucket_name}/{item_name}'
+        try:
+            if not self._detach(bucket_name, item_name):
+                # siad won't rename over an existing file
+                try:
+                    self.sia.delete_file(path)
+                except HttpError:
+                    pass
+            self.sia.rename_file(upload_path, path)
+        except Exception:
+            self._discard_upload(upload_path)
+            raise
+
+        with self.uploads_lock:
+            self.uploads.discard(upload_path)
+
+    def _discard_upload(self, upload_path):
+        try:
+            self.sia.delete_file(upload_path)
+        except HttpError:
+            pass
+        with self.uploads_lock:
+            self.uploads.discard(upload_path)
+
+    def _clean_uploads(self):
+        """Delete uploads left in UPLOADS_DIR by a previous run."""
+        try:
+            files = self.sia.list(f'{self.base_dir}/{UPLOADS_DIR}', fresh=True)['files']
+        except HttpError:
+            # Nothing's been uploaded yet
+            return
+
+        for file_details in files:
+            with self.uploads_lock:
+                if file_details['siapath'] in self.uploads:
+                    continue
+            logger.info('Deleting leftover upload %s', file_details['siapath'])
+            try:
+                self.sia.delete_file(file_details['siapath'])
+            except HttpError:
+                # Finished and moved since the listing
+                pass
+
+    def _list_uploads(self, path):
+        """List a directory for the upload tracker, which needs it fresh."""
+        try:
+            return self.sia.list(path, fresh=True)
+        except HttpError as e:
+            if is_not_found(e):
+                # The directory's gone, and with it the files being tracked
+                return {'files': []}
+            raise
+
+    def _uploaded(self, bucket_name, item_name, md5, available):
+        """Record that a synchronous upload is available for download."""
+        record = self.metadata.get(bucket_name, item_name)
+        # Unless it's been replaced since
+        if not available.exception() and record and record['etag'] == md5 and record['state'] == UPLOADING:
+            self.metadata.put(bucket_name, item_name, state=AVAILABLE)
+
+    def _store_data_write_back(self, bucket, item_name, content_type, data, etag):
+        m = hashlib.md5()
+        with self.file_cache.writer() as cache_file:
+            for chunk in data:
+                if not etag:
+                    m.update(chunk)
+                cache_file.write(chunk)
+            md5 = etag or m.hexdigest()
+
+            # Pinned until the upload completes
+            self.file_cache.pin(md5)
+            cache_file.commit(md5, sync=True)
+
+        with self.copy_lock:
+            self._detach(bucket.name, item_name)
+        return self._queue_upload(bucket.name, item_name, md5, cache_file.size, content_type)
+
+    def _queue_upload(self, bucket_name, item_name, md5, size, content_type):
+        """Queue the cached, and pinned, file md5 to be uploaded to sia."""
+        job = {
+            'key': f'{bucket_name}/{item_name}',
+            'bucket': bucket_name,
+            'item_name': item_name,
+            'md5': md5,
+            'size': size,
+            'modified_date': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'content_type': content_type,
+        }
+        previous = self.upload_queue.add(job)
+        if previous:
+            self.file_cache.unpin(previous['md5'])
+
+        self.metadata.put(
+            bucket_name,
+            item_name,
+            etag=md5,
+            size=size,
+            modified_date=job['modified_date'],
+            content_type=content_type,
+            state=PENDING,
+            source=None,
+        )
+        return S3Item(item_name, md5=md5, modified_date=job['modified_date'])
+
+    def _upload_job(self, job):
+        f = self.file_cache.open(job['md5'])
+        if not f:
+            # Nothing left to upload, which shouldn't happen while pinned
+            logger.warning('Cached data for %s is missing, skipping upload', job['key'])
+            return
+
+        with f:
+            upload_path = self._upload(iter(lambda: f.read(CHUNK_SIZE), b''))
+
+        with self.copy_lock:
+            if self.upload_queue.get(job['key']) is not job:
+                # Deleted or replaced while it was uploading
+                self._discard_upload(upload_path)
+                return
+            self._place_upload(upload_path, job['bucket'], job['item_name'])
+            self._set_state(job, UPLOADING)
+
+        # The job stays queued, and is served from the cache, until sia has it
+        done = Future()
+        self.upload_tracker.track(f'{self.base_dir}/{job["key"]}').add_done_callback(
+            functools.partial(self._upload_job_available, job, done)
+        )
+        return done
+
+    def _upload_job_available(self, job, done, available):
+        error = available.exception()
+        if isinstance(error, FileMissing) and not self.upload_queue.get(job['key']):
+            # Deleted while waiting for it to become available
+            done.set_result(None)
+        elif error:
+            done.set_exception(error)
+        else:
+            self._set_state(job, AVAILABLE)
+            done.set_result(None)
+
+    def _set_state(self, job, state):
+        # Unless the job has been replaced by a newer one
+        if self.upload_queue.get(job['key']) is job:
+            self.metadata.put(job['bucket'], job['item_name'], state=state)
+
+    def _upload_job_complete(self, job):
+        self.file_cache.unpin(job['md5'])
+
+    def _read_chunks(self, rfile, size):
+        while size > 0:
+            chunk = rfile.read(min(CHUNK_SIZE, size))
+            if not chunk:
+                raise Exception('Request body ended early')
+            size -= len(chunk)
+            yield chunk
+
     def store_item(self, bucket, item_name, handler):
         size = int(handler.headers['content-length'])
-        data = handler.rfile.read(size)
-        return self.store_data(bucket, item_name, {}, data)
+        headers = {}
+        if handler.headers.get('content-type'):
+            headers['content-type'] = handler.headers['content-type']
+        return self.store_data(bucket, item_name, headers, self._read_chunks(handler.rfile, size))
 
     def get_item(self, bucket_name, item_name, content=True):
+        """Get an item, with item.io streaming its contents if requested.
+
+        Contents come from the file cache when the md5 is known, otherwise
+        they're streamed from sia (and cached as they're read). sia is only
+        asked about the file if its metadata is incomplete, or its contents
+        are needed and aren't cached.
+        """
         key = f'{bucket_name}/{item_name}'
-        data = b''
-        try:
-            details = self.sia.get_file_status(f'{self.base_dir}/{key}')
+
+        # Not in sia yet, so serve it from the cache
+        record = self.metadata.get(bucket_name, item_name)
+        job = self.upload_queue and self.upload_queue.get(key)
+        if job:
+            item = S3Item(
+                key,
+                md5=job['md5'],
+                size=job['size'],
+                modified_date=job['modified_date'],
+                # The record's is newer if the object's been copied onto itself
+                content_type=(record and record['content_type']) or job.get('content_type') or 'unknown',
+            )
             if content:
-                md5 = self._md5(bucket_name, item_name, retrieve_on_miss=False)
-                if md5:
-                    data = self.file_cache.get(md5)
-                    if not data:
-                        data = self.sia.get_file(f'{self.base_dir}/{key}')
+                item.io = self._open_cached(job['md5'])
+            return item
+
+        known = record and record['etag'] and record['size'] is not None and record['modified_date']
+        if known and record['state'] == AVAILABLE:
+            item = S3Item(
+                key,
+                md5=record['etag'],
+                size=record['size'],
+                modified_date=record['modified_date'],
+                content_type=record['content_type'] or 'unknown',
+            )
+            if not content:
+                return item
+            item.io = self._open_cached(record['etag'])
+            if item.io:
+                return item
+
+        path = self._sia_path(bucket_name, item_name, record)
+        try:
+            details = self.status_lookups.do(path, lambda: self.sia.get_file_status(path))
         except HttpError as e:
             if e.status_code == 400:
                 raise NoSuchKey()
@@ -116,83 +682,497 @@ class SiaStore(object):
         if not details['available']:
             raise NoSuchKey()
 
-        m = hashlib.md5()
-        m.update(data)
-        md5 = m.hexdigest()
-        self.md5_cache.set(key, md5)
-
+        changes = {'size': details['filesize'], 'state': AVAILABLE}
+        if not (record and record['source']):
+            # A copy's contents were modified when the original was
+            changes['modified_date'] = details['modtime'].rsplit('.')[0] + '.000Z'
+        record = self.metadata.put(bucket_name, item_name, **changes)
+        md5 = record['etag']
         item = S3Item(
             key,
             md5=md5,
-            size=details['filesize'],
-            modified_date=details['modtime'].rsplit('.')[0] + '.000Z',
-            # Make up a content_type - this may break some clients
-            content_type='unknown',
+            size=record['size'],
+            modified_date=record['modified_date'],
+            # Make up a content_type if we don't know it - this may break some clients
+            content_type=record['content_type'] or 'unknown',
         )
-        item.io = io.BytesIO(data)
-        self.file_cache.put(md5, data)
+
+        if content:
+            item.io = md5 and self._open_cached(md5)
+            if not item.io:
+                item.io = self._stream(key, item.size, md5)
 
         return item
 
+    def get_range(self, item, start, end):
+        """Return a file-like object over bytes start-end (inclusive) of item.
+
+        The range is read from the file cache if possible, otherwise only the
+        requested bytes are streamed from sia.
+        """
+        f = item.md5 and self._open_cached(item.md5)
+        if f:
+            f.seek(start)
+            return f
+
+        if start == 0 and end == item.size - 1:
+            return self._stream(item.key, item.size, item.md5)
+
+        if item.md5 and self.range_chunk_size:
+            return ChunkReader(functools.partial(self._read_chunk, item), self.range_chunk_size, start, end)
+
+        chunks, resp = self.sia.stream_file(
+            self._sia_path(*item.key.split('/', 1)),
+            CHUNK_SIZE,
+            start=start,
+            end=end,
+        )
+        return SiaReader(chunks, resp, end - start + 1)
+
+    def _chunk_key(self, item, index):
+        return f'{item.md5}-{self.range_chunk_size}-{index}'
+
+    def _read_chunk(self, item, index):
+        """Return chunk index of item, from the file cache or sia."""
+        count = -(-item.size // self.range_chunk_size)
+        self.read_ahead.read(item.key, index, count, item)
+        data = self.file_cache.get(self._chunk_key(item, index))
+        if data is None:
+            data = self._fetch_chunk(item, index)
+        return data
+
+    def _prefetch_chunk(self, item, index):
+        if not self.file_cache.contains(self._chunk_key(item, index)):
+            self._fetch_chunk(item, index)
+
+    def _fetch_chunk(self, item, index):
+        """Download chunk index of item from sia into the file cache."""
+        chunk_key = self._chunk_key(item, index)
+
+        def fetch():
+            # It may have been fetched since the caller looked
+            data = self.file_cache.get(chunk_key)
+            if data is not None:
+                return data
+
+            start = index * self.range_chunk_size
+            end = min(start + self.range_chunk_size, item.size) - 1
+            chunks, resp = self.sia.stream_file(
+                self._sia_path(*item.key.split('/', 1)),
+                CHUNK_SIZE,
+                start=start,
+                end=end,
+            )
+            with contextlib.closing(resp):
+                data = SiaReader(chunks, resp, end - start + 1).read()
+            if len(data) != end - start + 1:
+                raise IOError(f'Read {len(data)} of {end - start + 1} bytes of chunk {index} of {item.key}')
+            self.file_cache.put(chunk_key, data)
+            return data
+
+        # Readers and read ahead share fetches of the same chunk
+        return self.chunk_fetches.do(chunk_key, fetch)
+
+    def _open_cached(self, md5):
+        """Open md5 from the memory or file cache, or return None.
+
+        Small files read from disk are promoted into the memory cache.
+        """
+        data = self.memory_cache.get(md5)
+        if data is not None:
+            return io.BytesIO(data)
+
+        f = self.file_cache.open(md5)
+        if f and self.memory_cache.accepts(os.fstat(f.fileno()).st_size):
+            with f:
+                data = f.read()
+            self.memory_cache.put(md5, data)
+            return io.BytesIO(data)
+
+        return f
+
+    def _stream(self, key, size, md5=None):
+        """Stream a whole file from sia, filling the file cache.
+
+        If it's already being downloaded the new reader follows that download
+        rather than starting another.
+        """
+        bucket_name, item_name = key.split('/', 1)
+        path = self._sia_path(bucket_name, item_name)
+        with self.downloads_lock:
+            download = self.downloads.get(path)
+            reader = download and download.reader()
+            leader = not reader
+            if leader:
+                download = SharedDownload(
+                    self.file_cache.writer(),
+                    size,
+                    md5,
+                    lambda md5: self.metadata.put(bucket_name, item_name, etag=md5),
+                    lambda: self._download_finished(path, download),
+                )
+                self.downloads[path] = download
+                reader = download.reader()
+
+        if not leader:
+            try:
+                download.wait_started()
+            except Exception:
+                reader.close()
+                raise
+            return reader
+
+        # Large files are downloaded in segments, several at once
+        segmented = self.download_workers > 1 and self.download_segment_size and size > self.download_segment_size
+        try:
+            if segmented:
+                chunks, resp = self.sia.stream_file(path, CHUNK_SIZE, start=0, end=self.download_segment_size - 1)
+            else:
+                chunks, resp = self.sia.stream_file(path, CHUNK_SIZE)
+        except Exception as e:
+            download.fail(e)
+            reader.close()
+            raise
+
+        if segmented:
+            download.start(
+                chunks,
+                resp,
+                lambda start, end: self.sia.stream_file(path, CHUNK_SIZE, start=start, end=end),
+                self.download_segment_size,
+                self.download_workers,
+            )
+        else:
+            download.start(chunks, resp)
+        return reader
+
+    def _download_finished(self, path, download):
+        with self.downloads_lock:
+            if self.downloads.get(path) is download:
+                del self.downloads[path]
+
+    def create_multipart_upload(self, bucket, item_name, content_type=None):
+        return self.multipart_uploads.create(bucket.name, item_name, content_type)
+
+    def upload_part(self, bucket, item_name, upload_id, part_number, handler):
+        self._check_upload(bucket, item_name, upload_id)
+        size = int(handler.headers['content-length'])
+        return self.multipart_uploads.store_part(upload_id, part_number, self._read_chunks(handler.rfile, size))
+
+    def list_parts(self, bucket, item_name, upload_id):
+        self._check_upload(bucket, item_name, upload_id)
+        return self.multipart_uploads.list_parts(upload_id)
+
+    def complete_multipart_upload(self, bucket, item_name, upload_id, parts):
+        upload = self._check_upload(bucket, item_name, upload_id)
+        etag, size, chunks = self.multipart_uploads.assemble(upload_id, parts, CHUNK_SIZE)
+        headers = {}
+        if upload.get('content_type'):
+            headers['content-type'] = upload['content_type']
+        item = self.store_data(bucket, item_name, headers, chunks, etag=etag)
+        self.multipart_uploads.remove(upload_id)
+        return item
+
+    def abort_multipart_upload(self, bucket, item_name, upload_id):
+        self._check_upload(bucket, item_name, upload_id)
+        self.multipart_uploads.remove(upload_id)
+
+    def _check_upload(self, bucket, item_name, upload_id):
+        upload = self.multipart_uploads.get(upload_id)
+        if upload['bucket'] != bucket.name or upload['key'] != item_name:
+            raise NoSuchUpload()
+        return upload
+
+    def copy_item(self, src_bucket, src_key, bucket_name, item_name, content_type=None):
+        """Copy an object without copying its contents.
+
+        The copy refers to the original's contents in sia (or, for objects
+        still waiting to be uploaded, its cached file is queued again). If
+        content_type is given it replaces the original's.
+        """
+        modified_date = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        item = self.get_item(src_bucket, src_key, content=False)
+        if not item.md5:
+            # Clients keep the etag a copy returns, so it can't be left blank
+            # for the backfill like in listings
+            item.md5, _ = self._hash_file(self._sia_path(src_bucket, src_key))
+            self.metadata.put(src_bucket, src_key, etag=item.md5)
+        if (src_bucket, src_key) == (bucket_name, item_name):
+            # Copying an object onto itself just replaces its metadata
+            self.metadata.put(bucket_name, item_name, content_type=content_type, modified_date=modified_date)
+            return S3Item(item_name, md5=item.md5, modified_date=modified_date)
+
+        job = self.upload_queue and self.upload_queue.get(f'{src_bucket}/{src_key}')
+        if job:
+            self.file_cache.pin(job['md5'])
+            with self.copy_lock:
+                self._detach(bucket_name, item_name)
+            return self._queue_upload(
+                bucket_name,
+                item_name,
+                job['md5'],
+                job['size'],
+                content_type or job.get('content_type'),
+            )
+
+        with self.copy_lock:
+            # Replace whatever's there already
+            job = self.upload_queue and self.upload_queue.remove(f'{bucket_name}/{item_name}')
+            if job:
+                self.file_cache.unpin(job['md5'])
+            if not self._detach(bucket_name, item_name):
+                try:
+                    self.sia.delete_file(f'{self.base_dir}/{bucket_name}/{item_name}')
+                except HttpError:
+                    pass
+
+            record = self.metadata.get(src_bucket, src_key) or {}
+            self.metadata.put(
+                bucket_name,
+                item_name,
+                etag=item.md5,
+                size=item.size,
+                modified_date=modified_date,
+                content_type=content_type or record.get('content_type'),
+                state=record.get('state') or AVAILABLE,
+                # Looked up after detaching, which could have moved them
+                source=self._sia_path(src_bucket, src_key),
+            )
+
+        return S3Item(item_name, md5=item.md5, modified_date=modified_date)
+
+    def _sia_path(self, bucket_name, item_name, record=None):
+        """Get the siapath of an object's contents."""
+        record = record or self.metadata.get(bucket_name, item_name)
+        if record and record['source']:
+            return record['source']
+        return f'{self.base_dir}/{bucket_name}/{item_name}'
+
+    def _detach(self, bucket_name, item_name):
+        """Get an object ready for its contents to be replaced or deleted.
+
+        If the object is a copy it stops referring to the original's
+        contents. If it has copies its contents are moved into SHARED_DIR
+        for them. Either way True is returned, as there's nothing left at
+        its path in sia. Called with copy_lock held.
+        """
+        record = self.metadata.get(bucket_name, item_name)
+        if record and record['source']:
+            self.metadata.put(bucket_name, item_name, source=None)
+            self._release(record['source'])
+            return True
+
+        path = f'{self.base_dir}/{bucket_name}/{item_name}'
+        copies = self.metadata.references(path)
+        if copies:
+            shared_path = f'{self.base_dir}/{SHARED_DIR}/{uuid.uuid4().hex}'
+            self.sia.rename_file(path, shared_path)
+            for copy_bucket, copy_key in copies:
+                self.metadata.put(copy_bucket, copy_key, source=shared_path)
+            return True
+        return False
+
+    def _release(self, source):
+        """Delete shared contents from sia once no copies refer to them."""
+        if source.startswith(f'{self.base_dir}/{SHARED_DIR}/') and not self.metadata.references(source):
+            self.sia.delete_file(source)
+
     def delete_item(self, bucket_name, item_name):
+        self._delete_item(bucket_name, item_name)
+        self.metadata.delete(bucket_name, item_name)
+
+    def delete_items(self, bucket_name, item_names):
+        """Delete several items at once, by up to delete_workers threads.
+
+        Returns a list of (item_name, error), where error is None if it was
+        deleted. A failure doesn't stop the other items being deleted.
+        """
+        def delete(item_name):
+            try:
+                self._delete_item(bucket_name, item_name)
+            except Exception as e:
+                return item_name, e
+            return item_name, None
+
+        workers = max(1, min(self.delete_workers, len(item_names)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(delete, item_names))
+
+        self.metadata.delete_many(bucket_name, [item_name for item_name, error in results if not error])
+        return results
+
+    def _delete_item(self, bucket_name, item_name):
+        """Delete an item from sia, leaving its metadata record to the caller."""
         # s3 doesn't differentiate between files and folders, but sia does. If
         # file deletion fails, assume it was a folder, and delete that. Side
         # note: If you create files and folders with the same name within Sia,
         # this can cause weird situations in s3.
         path = f'{self.base_dir}/{bucket_name}/{item_name}'
+        if item_name.endswith('/'):
+            # Only ever a folder, so don't try it as a file first
+            try:
+                self.sia.delete_folder(path.rstrip('/'))
+            except HttpError as e:
+                if not is_not_found(e):
+                    raise
+            return
+
+        job = self.upload_queue and self.upload_queue.remove(f'{bucket_name}/{item_name}')
+        if job:
+            self.file_cache.unpin(job['md5'])
+
+        with self.copy_lock:
+            if self._detach(bucket_name, item_name):
+                return
+
         try:
             self.sia.delete_file(path)
-            self.md5_cache.rem(f'{bucket_name}/{item_name}')
-        except Exception:
-            self.sia.delete_folder(path)
+        except Exception as e:
+            if job:
+                # Never made it to sia
+                return
+            if self.metadata.get(bucket_name, item_name):
+                # A file we know about, so not a folder
+                if is_not_found(e):
+                    return
+                raise
+            try:
+                self.sia.delete_folder(path)
+            except HttpError as folder_error:
+                # Neither a file nor a folder, so already gone, which S3
+                # counts as deleted
+                if not (is_not_found(e) and is_not_found(folder_error)):
+                    raise
+
+    def _relative_path(self, bucket, siapath):
+        """Strip the bucket directory from a siapath."""
+        return siapath[len(f'{self.base_dir}/{bucket.name}/'):]
+
+    def _list_dir(self, bucket, path):
+        """List a directory of a bucket for DirWalker."""
+        try:
+            results = self.sia.list(f'{self.base_dir}/{bucket.name}/{path}')
+        except HttpError:
+            # No such directory, but there could still be copies or
+            # pending uploads under it
+            return [], []
+
+        files = []
+        for file_details in results['files']:
+            files.append((self._relative_path(bucket, file_details['siapath']), file_details))
+
+        directories = []
+        for dir_details in results['directories']:
+            directory = self._relative_path(bucket, dir_details['siapath'])
+            # Skip the directory itself
+            if directory and directory != path.rstrip('/'):
+                directories.append(directory + '/')
+
+        return files, directories
 
     def get_all_keys(self, bucket, **kwargs):
+        """List a bucket, from sia's directory listings and the metadata index.
+
+        Files are never downloaded here, so the etag of a file that hasn't
+        been seen before is left blank until the backfill gets to it. Keys
+        are listed in order from after the marker, so each page only costs
+        listing the directories it covers. They're listed as the returned
+        query's entries are iterated over, so can be sent as they arrive.
+        """
         max_keys = int(kwargs['max_keys'])
         prefix = kwargs.get('prefix')
         delimiter = kwargs.get('delimiter', '')
+        marker = kwargs.get('marker', '')
         if delimiter not in set(['/', '']):
             raise Exception('Delimiter only supports / or `` currently')
 
-        is_truncated = False
-        matches = []
-        common_prefixes = []
-        directories_to_walk = [f'{prefix}']
-        walked_directories = set(directories_to_walk)
-        
-        while len(directories_to_walk) > 0:
-            path = directories_to_walk.pop(-1)
-
-            try:
-                results = self.sia.list(f'{self.base_dir}/{bucket.name}/{path}')
-            except Exception:
-                raise NoSuchKey()
+        bucket_query = BucketQuery(bucket, **kwargs)
+        bucket_query.entries = self._list_entries(bucket_query, bucket, max_keys, prefix, delimiter, marker)
+        return bucket_query
 
-            for file_details in results['files']:
-                key = file_details['siapath'].lstrip(f'{self.base_dir}/{bucket.name}')
+    def _list_entries(self, bucket_query, bucket, max_keys, prefix, delimiter, marker):
+        if max_keys <= 0:
+            # An empty page, which can't be truncated without a key to
+            # continue after
+            return
 
-                matches.append(S3Item(
-                    key,
-                    md5=self._md5(bucket.name, key),
-                    modified_date=file_details['modtime'][:-10] + '000Z',
-                    size=file_details['filesize'],
-                ))
+        listed = 0
+        last_key = None
 
-            for dir_details in results['directories']:
-                directory = dir_details['siapath']
-                path = directory.lstrip(f'{self.base_dir}/{bucket.name}') + '/'
+        # With a delimiter, subdirectories are common prefixes rather than walked
+        walker = DirWalker(functools.partial(self._list_dir, bucket), workers=self.list_workers)
+        walked = walker.walk(prefix, recursive=delimiter != '/', start_after=marker)
+        with contextlib.closing(walked):
+            # Copies and pending uploads go first, so they replace any older
+            # version in sia
+            entries = [
+                self._copied_items(bucket, prefix, delimiter, marker),
+                self._listed_items(bucket, walked),
+            ]
+            if self.upload_queue:
+                entries.insert(0, self._pending_items(bucket, prefix, delimiter, marker))
+            entries = heapq.merge(*entries, key=itemgetter(0))
 
-                if path in walked_directories or path == '/':
+            for key, item in entries:
+                if key == last_key:
                     continue
+                if listed >= max_keys:
+                    bucket_query.is_truncated = True
+                    bucket_query.next_marker = last_key
+                    return
+
+                listed += 1
+                last_key = key
+                yield key, item
+
+    def _listed_items(self, bucket, walked):
+        for key, file_details in walked:
+            if file_details is None:
+                yield key, None
+                continue
 
-                # Check for common prefixes
-                if delimiter == '/':
-                    common_prefixes.append(path)
-                elif path not in walked_directories:
-                    directories_to_walk.append(path)
-                    walked_directories.add(path)
+            yield key, S3Item(
+                key,
+                md5=self._etag(bucket.name, key) or '',
+                modified_date=file_details['modtime'][:-10] + '000Z',
+                size=file_details['filesize'],
+            )
 
-            if len(matches) >= max_keys:
-                is_truncated = True
-                break
+    def _copied_items(self, bucket, prefix, delimiter, marker):
+        """List copies, which aren't in sia's directories, like _listed_items."""
+        for key, record in self.metadata.copies(bucket.name, prefix, marker):
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                common_prefix = prefix + rest.split(delimiter)[0] + delimiter
+                if common_prefix > marker:
+                    yield common_prefix, None
+                continue
+
+            yield key, S3Item(
+                key,
+                md5=record['etag'] or '',
+                modified_date=record['modified_date'],
+                size=record['size'],
+            )
+
+    def _pending_items(self, bucket, prefix, delimiter, marker):
+        """List keys waiting to be uploaded to sia, like _listed_items."""
+        items = {}
+        for job in self.upload_queue.pending():
+            key = job['item_name']
+            if job['bucket'] != bucket.name or not key.startswith(prefix):
+                continue
+
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                common_prefix = prefix + rest.split(delimiter)[0] + delimiter
+                items[common_prefix] = None
+            else:
+                items[key] = S3Item(
+                    key,
+                    md5=job['md5'],
+                    modified_date=job['modified_date'],
+                    size=job['size'],
+                )
 
-        return BucketQuery(bucket, matches, is_truncated, common_prefixes, **kwargs)
+        return sorted((key, item) for key, item in items.items() if key > marker)
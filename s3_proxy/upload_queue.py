@@ -0,0 +1,144 @@
+from concurrent.futures import Future
+import hashlib
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+class UploadQueue(object):
+    """Persistent queue of uploads to sia, drained by a pool of workers.
+
+    Each job is a dict with at least a 'key' (bucket/item name) and is saved
+    to queue_dir until upload(job) returns successfully, so pending uploads
+    survive restarts, then on_complete(job) is called. upload may instead
+    return a Future, which the job waits on without holding up a worker. Failed uploads are
+    retried with backoff. A newer job for the same key replaces an older one,
+    and jobs for the same key are never uploaded concurrently.
+    """
+
+    def __init__(self, queue_dir, upload, on_complete=None, workers=4, max_retry_delay=300):
+        if not os.path.exists(queue_dir):
+            os.makedirs(queue_dir)
+
+        self.queue_dir = queue_dir
+        self.upload = upload
+        self.on_complete = on_complete
+        self.workers = workers
+        self.max_retry_delay = max_retry_delay
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.in_flight = set()
+        self.rerun = set()
+        self.queue = queue.Queue()
+        self._load()
+
+    def _path(self, key):
+        return '%s/%s.json' % (self.queue_dir, hashlib.sha1(key.encode()).hexdigest())
+
+    def _load(self):
+        for name in os.listdir(self.queue_dir):
+            path = f'{self.queue_dir}/{name}'
+            if not name.endswith('.json'):
+                os.remove(path)
+                continue
+
+            with open(path) as f:
+                job = json.load(f)
+            self.jobs[job['key']] = job
+        logger.info('Loaded %s pending uploads', len(self.jobs))
+
+    def start(self):
+        for key in self.jobs:
+            self.queue.put((key, 0))
+
+        for _ in range(self.workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def add(self, job):
+        """Durably queue job, returning the job it replaced if there was one."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.queue_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(job, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        with self.lock:
+            os.rename(tmp_path, self._path(job['key']))
+            previous = self.jobs.get(job['key'])
+            self.jobs[job['key']] = job
+
+        self.queue.put((job['key'], 0))
+        return previous
+
+    def get(self, key):
+        return self.jobs.get(key)
+
+    def pending(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def remove(self, key):
+        """Cancel any pending upload for key, returning its job."""
+        with self.lock:
+            job = self.jobs.pop(key, None)
+            if job:
+                os.remove(self._path(key))
+        return job
+
+    def _work(self):
+        while True:
+            key, attempts = self.queue.get()
+            with self.lock:
+                job = self.jobs.get(key)
+                if not job:
+                    continue
+                if key in self.in_flight:
+                    # Picked up again once the current upload finishes
+                    self.rerun.add(key)
+                    continue
+                self.in_flight.add(key)
+
+            try:
+                result = self.upload(job)
+            except Exception as e:
+                self._finished(key, job, attempts, e)
+                continue
+
+            if isinstance(result, Future):
+                # Finished in the background, freeing this worker up
+                result.add_done_callback(
+                    lambda future, key=key, job=job, attempts=attempts: self._finished(
+                        key, job, attempts, future.exception()
+                    )
+                )
+            else:
+                self._finished(key, job, attempts, None)
+
+    def _finished(self, key, job, attempts, error):
+        if error:
+            delay = min(2 ** attempts, self.max_retry_delay)
+            logger.error('Upload of %s failed, retrying in %ss', key, delay, exc_info=error)
+            threading.Timer(delay, self.queue.put, [(key, attempts + 1)]).start()
+            job = None
+
+        with self.lock:
+            self.in_flight.discard(key)
+            if job and self.jobs.get(key) is job:
+                del self.jobs[key]
+                os.remove(self._path(key))
+            else:
+                job = None
+            if key in self.rerun:
+                self.rerun.discard(key)
+                self.queue.put((key, 0))
+
+        if job:
+            logger.info('Finished uploading %s', key)
+            if self.on_complete:
+                self.on_complete(job)
@@ -0,0 +1,105 @@
+from concurrent.futures import Future
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class FileMissing(Exception):
+    """The file being tracked is no longer in sia, eg it was deleted."""
+
+
+class UploadTracker(object):
+    """Waits for files uploaded to sia to become available for download.
+
+    track(siapath) returns a Future that's resolved once the file is
+    available. All the files being tracked are checked by one thread, with
+    one listing per directory, list_dir(path), rather than a status request
+    per file. Checks are min_interval apart while uploads are completing,
+    backing off to max_interval while none are. If a directory can't be
+    listed max_failures times in a row, the files in it fail with the error.
+    """
+
+    def __init__(self, list_dir, min_interval=1, max_interval=30, max_failures=10):
+        self.list_dir = list_dir
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_failures = max_failures
+        self.interval = min_interval
+        self.cond = threading.Condition()
+        # siapath -> Future
+        self.waiting = {}
+        # Directory -> failed listings in a row
+        self.failures = {}
+
+    def start(self):
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def track(self, siapath):
+        siapath = siapath.strip('/')
+        with self.cond:
+            future = self.waiting.get(siapath)
+            if not future:
+                future = self.waiting[siapath] = Future()
+                # Small uploads are often available straight away
+                self.interval = self.min_interval
+                self.cond.notify()
+            return future
+
+    def pending(self):
+        with self.cond:
+            return len(self.waiting)
+
+    def _work(self):
+        checked = 0
+        while True:
+            with self.cond:
+                while not self.waiting or time.monotonic() < checked + self.interval:
+                    self.cond.wait(checked + self.interval - time.monotonic() if self.waiting else None)
+                paths = list(self.waiting)
+
+            checked = time.monotonic()
+            directories = {}
+            for path in paths:
+                directories.setdefault(path.rpartition('/')[0], []).append(path)
+
+            resolved = {}
+            for directory, paths in directories.items():
+                try:
+                    files = self.list_dir(directory)['files']
+                except Exception as e:
+                    failures = self.failures.get(directory, 0) + 1
+                    if failures < self.max_failures:
+                        logger.warning('Failed to check uploads in %s: %s', directory, e)
+                        self.failures[directory] = failures
+                        continue
+
+                    logger.error('Giving up on uploads in %s after %s failed checks: %s', directory, failures, e)
+                    self.failures.pop(directory, None)
+                    for path in paths:
+                        resolved[path] = e
+                    continue
+
+                self.failures.pop(directory, None)
+
+                details = dict((file_details['siapath'], file_details) for file_details in files)
+                for path in paths:
+                    if path not in details:
+                        resolved[path] = FileMissing(path)
+                    elif details[path]['available']:
+                        resolved[path] = None
+
+            with self.cond:
+                futures = [(self.waiting.pop(path), error) for path, error in resolved.items()]
+                if futures:
+                    self.interval = self.min_interval
+                else:
+                    self.interval = min(self.interval * 2, self.max_interval)
+
+            for future, error in futures:
+                if error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(True)
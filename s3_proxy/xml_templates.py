@@ -1,4 +1,4 @@
-buckets_xml = '''\
+buckets_start_xml = '''\
 <?xml version="1.0" encoding="UTF-8"?>
 <ListAllMyBucketsResult xmlns="http://doc.s3.amazonaws.com/2006-03-01">
   <Owner>
@@ -6,31 +6,65 @@ buckets_xml = '''\
     <DisplayName>MockS3</DisplayName>
   </Owner>
   <Buckets>
-{buckets}
-  </Buckets>
-</ListAllMyBucketsResult>'''
+'''
 
 buckets_bucket_xml = '''\
     <Bucket>
-      <Name>{bucket.name}</Name>
+      <Name>{name}</Name>
       <CreationDate>{bucket.creation_date}</CreationDate>
-    </Bucket>'''
+    </Bucket>
+'''
+
+buckets_end_xml = '''\
+  </Buckets>
+</ListAllMyBucketsResult>'''
 
-bucket_query_xml = '''\
+# Listings are streamed, so their truncation is only known at the end
+bucket_query_start_xml = '''\
 <?xml version="1.0" encoding="UTF-8"?>
 <ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01">
-  <Name>{bucket_query.bucket.name}</Name>
-  <Prefix>{bucket_query.prefix}</Prefix>
-  <Marker>{bucket_query.marker}</Marker>
+  <Name>{name}</Name>
+  <Prefix>{prefix}</Prefix>
+  <Marker>{marker}</Marker>
   <MaxKeys>{bucket_query.max_keys}</MaxKeys>
-  <IsTruncated>false</IsTruncated>
-{contents}
-{common_prefixes}
-</ListBucketResult>'''
+'''
+
+bucket_query_end_xml = '''\
+  <IsTruncated>{is_truncated}</IsTruncated>
+{next_marker}</ListBucketResult>'''
+
+bucket_query_next_marker_xml = '''\
+  <NextMarker>{next_marker}</NextMarker>
+'''
+
+bucket_query_v2_start_xml = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01">
+  <Name>{name}</Name>
+  <Prefix>{prefix}</Prefix>
+  <MaxKeys>{bucket_query.max_keys}</MaxKeys>
+{continuation}'''
+
+bucket_query_v2_end_xml = '''\
+  <KeyCount>{key_count}</KeyCount>
+  <IsTruncated>{is_truncated}</IsTruncated>
+{continuation}</ListBucketResult>'''
+
+bucket_query_continuation_token_xml = '''\
+  <ContinuationToken>{token}</ContinuationToken>
+'''
+
+bucket_query_next_continuation_token_xml = '''\
+  <NextContinuationToken>{token}</NextContinuationToken>
+'''
+
+bucket_query_start_after_xml = '''\
+  <StartAfter>{start_after}</StartAfter>
+'''
 
 bucket_query_content_xml = '''\
   <Contents>
-    <Key>{s3_item.key}</Key>
+    <Key>{key}</Key>
     <LastModified>{s3_item.modified_date}</LastModified>
     <ETag>&quot;{s3_item.md5}&quot;</ETag>
     <Size>{s3_item.size}</Size>
@@ -39,12 +73,14 @@ bucket_query_content_xml = '''\
       <ID>123</ID>
       <DisplayName>MockS3</DisplayName>
     </Owner>
-  </Contents>'''
+  </Contents>
+'''
 
 common_prefixes_content_xml = '''\
   <CommonPrefixes>
     <Prefix>{prefix}</Prefix>
-  </CommonPrefixes>'''
+  </CommonPrefixes>
+'''
 
 error_no_such_bucket_xml = '''\
 <?xml version="1.0" encoding="UTF-8"?>
@@ -64,6 +100,51 @@ error_no_such_key_xml = '''\
   <RequestId>1</RequestId>
 </Error>'''
 
+error_invalid_range_xml = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<Error>
+  <Code>InvalidRange</Code>
+  <Message>The requested range is not satisfiable</Message>
+  <Resource>{name}</Resource>
+  <RequestId>1</RequestId>
+</Error>'''
+
+error_invalid_argument_xml = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<Error>
+  <Code>InvalidArgument</Code>
+  <Message>{message}</Message>
+  <Resource>{name}</Resource>
+  <RequestId>1</RequestId>
+</Error>'''
+
+error_precondition_failed_xml = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<Error>
+  <Code>PreconditionFailed</Code>
+  <Message>At least one of the preconditions you specified did not hold.</Message>
+  <Resource>{name}</Resource>
+  <RequestId>1</RequestId>
+</Error>'''
+
+error_not_implemented_xml = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<Error>
+  <Code>NotImplemented</Code>
+  <Message>A header or query you provided implies functionality that is not implemented.</Message>
+  <Resource>{name}</Resource>
+  <RequestId>1</RequestId>
+</Error>'''
+
+error_slow_down_xml = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<Error>
+  <Code>SlowDown</Code>
+  <Message>Please reduce your request rate.</Message>
+  <Resource>{name}</Resource>
+  <RequestId>1</RequestId>
+</Error>'''
+
 acl_xml = '''\
 <?xml version="1.0" encoding="UTF-8"?>
 <AccessControlPolicy xmlns="http://s3.amazonaws.com/doc/2006-03-01">
@@ -92,3 +173,83 @@ deleted_deleted_xml = '''\
   <Deleted>
     <Key>{key}</Key>
   </Deleted>'''
+
+deleted_error_xml = '''\
+  <Error>
+    <Key>{key}</Key>
+    <Code>{code}</Code>
+    <Message>{message}</Message>
+  </Error>'''
+
+
+initiate_multipart_upload_xml = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<InitiateMultipartUploadResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
+  <Bucket>{bucket}</Bucket>
+  <Key>{key}</Key>
+  <UploadId>{upload_id}</UploadId>
+</InitiateMultipartUploadResult>'''
+
+complete_multipart_upload_xml = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<CompleteMultipartUploadResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
+  <Location>/{bucket}/{key}</Location>
+  <Bucket>{bucket}</Bucket>
+  <Key>{key}</Key>
+  <ETag>&quot;{etag}&quot;</ETag>
+</CompleteMultipartUploadResult>'''
+
+list_parts_xml = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<ListPartsResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
+  <Bucket>{bucket}</Bucket>
+  <Key>{key}</Key>
+  <UploadId>{upload_id}</UploadId>
+  <Initiator>
+    <ID>123</ID>
+    <DisplayName>MockS3</DisplayName>
+  </Initiator>
+  <Owner>
+    <ID>123</ID>
+    <DisplayName>MockS3</DisplayName>
+  </Owner>
+  <StorageClass>STANDARD</StorageClass>
+  <PartNumberMarker>0</PartNumberMarker>
+  <NextPartNumberMarker>{next_part_number_marker}</NextPartNumberMarker>
+  <MaxParts>10000</MaxParts>
+  <IsTruncated>false</IsTruncated>
+{parts}
+</ListPartsResult>'''
+
+list_parts_part_xml = '''\
+  <Part>
+    <PartNumber>{part.part_number}</PartNumber>
+    <LastModified>{part.modified_date}</LastModified>
+    <ETag>&quot;{part.md5}&quot;</ETag>
+    <Size>{part.size}</Size>
+  </Part>'''
+
+copy_object_result_xml = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<CopyObjectResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">
+  <LastModified>{s3_item.modified_date}</LastModified>
+  <ETag>&quot;{s3_item.md5}&quot;</ETag>
+</CopyObjectResult>'''
+
+error_no_such_upload_xml = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<Error>
+  <Code>NoSuchUpload</Code>
+  <Message>The specified multipart upload does not exist.</Message>
+  <Resource>{name}</Resource>
+  <RequestId>1</RequestId>
+</Error>'''
+
+error_invalid_part_xml = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<Error>
+  <Code>InvalidPart</Code>
+  <Message>One or more of the specified parts could not be found.</Message>
+  <Resource>{name}</Resource>
+  <RequestId>1</RequestId>
+</Error>'''